@@ -1,10 +1,33 @@
 import re
-import requests
 import json
 import boto3
 import os
+import threading
+import http_client
 from datetime import datetime
-from requests.structures import CaseInsensitiveDict
+from concurrent.futures import ThreadPoolExecutor
+
+GEOAPIFY_PLACES_URL = "https://api.geoapify.com/v2/places"
+PAGE_SIZE = 500
+# A tile is split into quadrants until its results fit within this many pages, or it is too small to split
+MAX_TILE_PAGES = int(os.environ.get("MAX_TILE_PAGES", "4"))
+MIN_TILE_DEGREES = 0.005
+
+# S3 multipart uploads need parts of at least 5 MB, except for the last one
+UPLOAD_PART_BYTES = 5 * 1024 * 1024
+
+# Tiles probed or fetched at once, and the Geoapify API requests per second allowed across every scraper running at once
+TILE_WORKERS = int(os.environ.get("TILE_WORKERS", "4"))
+GEOAPIFY_REQUESTS_PER_SECOND = float(os.environ.get("GEOAPIFY_REQUESTS_PER_SECOND", "5"))
+# The rate limit is kept per container, so each of the scrapers capped by the reserved concurrency gets an even share
+GEOAPIFY_SCRAPER_CONCURRENCY = int(os.environ.get("GEOAPIFY_SCRAPER_CONCURRENCY", "1"))
+
+# Time left when the scraper stops fetching, uploads what it has and continues in a new invocation,
+# enough for the pages in flight with their retries and the last part of the upload
+CONTINUATION_MARGIN_MS = int(os.environ.get("CONTINUATION_MARGIN_MS", "120000"))
+
+# Tiling of the last invocation
+tiling_stats = {"tiles": 0, "probes": 0, "records": 0, "duplicates": 0, "unmatched": 0, "continued_tiles": 0}
 
 # Schema for POI Data formatted
 poi_data_schema = {
@@ -31,78 +54,344 @@ poi_data_schema = {
 def handler(event, context):
     # Configure the search terms
     category = event["category"]
-    lon1 = event["lon1"]
-    lat1 = event["lat1"]
-    lon2 = event["lon2"]
-    lat2 = event["lat2"]
+    lon1 = float(event["lon1"])
+    lat1 = float(event["lat1"])
+    lon2 = float(event["lon2"])
+    lat2 = float(event["lat2"])
+
+    # Set when the invocation continues a scrape that was about to time out
+    continuation = event.get("continuation")
+
+    # Set by the invoker when the category is scraped in several tasks, and to spread the tasks over several API keys
+    task = event.get("task")
+    api_key_index = event.get("api_key_index", 0)
+
+    # Set by the invoker when several regions are scraped, the names of the regions covering the rectangle
+    regions = event.get("regions")
 
-    message = main(category, lon1, lat1, lon2, lat2)
+    # Set by the invoker so that tasks deferred to a later day are stored with the rest of their run
+    run_date = event.get("run_date")
 
-    return {"message": message}
+    http_client.reset_latency_stats()
+    message = main(category, lon1, lat1, lon2, lat2, context, continuation, task, api_key_index, regions, run_date)
 
-def main(category, lon1, lat1, lon2, lat2, file_dir='/tmp'):
+    return {"message": message, "latency_stats": http_client.get_latency_stats(), "tiling_stats": dict(tiling_stats)}
+
+def main(category, lon1, lat1, lon2, lat2, context=None, continuation=None, task=None, api_key_index=0, regions=None, run_date=None):
     # Retrieve Geoapify API Key from environment variables
-    geoapify_api_key = os.environ["GEOAPIFY_API_KEY"]
+    geoapify_api_key = get_geoapify_api_key(api_key_index)
+
+    # Outputs are stored under the date of the run, kept by the continuations of the scrape
+    if run_date is None:
+        run_date = datetime.today().strftime('%Y-%m-%d')
 
     # Initialise S3 client for uploading
     client = boto3.client("s3")
 
-    geoapify_response_dict = dict()
-    record_dict = dict()
+    http_client.set_rate_limit(GEOAPIFY_REQUESTS_PER_SECOND / GEOAPIFY_SCRAPER_CONCURRENCY)
+    tiling_stats.update({"tiles": 0, "probes": 0, "records": 0, "duplicates": 0, "unmatched": 0, "continued_tiles": 0})
 
-    # Iterate through to get all results
-    page_size = 500
-    page = 0
-    
-    query_done = False
-
-    # Make API Request to get POIs by place id
-    while not query_done:
-        try:
-            offset = page * page_size
-            url = f"https://api.geoapify.com/v2/places?categories={category}&filter=rect:{lon1},{lat1},{lon2},{lat2}&limit={page_size}&offset={offset}&apiKey={geoapify_api_key}"
-            
-            headers = CaseInsensitiveDict()
-            headers["Accept"] = "application/json"
-            poi_response = requests.get(url, headers=headers)
-            
-            if poi_response.json()["features"] == []:
-                raise Exception("No more results found")
-            
-            for record in poi_response.json()["features"]:
-                record = record["properties"]
-                id = record["place_id"]
-                formatted_record = poi_schema_formatter(record, poi_data_schema)
-                geoapify_response_dict[id] = formatted_record
-                record_dict[id] = formatted_record
-                
-            page += 1
+    if continuation is None:
+        # Split the rectangle into tiles that each fit within a few pages, so that no tile is paged deeply
+        tiles = plan_tiles(category, (lon1, lat1, lon2, lat2), geoapify_api_key)
+        # Each task is a tile and the offset of its next page
+        tasks = [[*tile, 0] for tile in tiles]
+        segment = 0
+    else:
+        # Pick up the tiles of the previous invocation from the pages it did not fetch
+        tasks = continuation["tasks"]
+        segment = continuation["segment"]
+    tiling_stats["tiles"] = len(tasks)
+
+    # Sparse categories may be scraped together in one comma separated query, and are split back per category
+    categories = category.split(",")
+
+    # Stream the records of each page into a multipart upload of one JSON object per category, so that only
+    # the place ids and the parts being uploaded are held in memory
+    uploads = {}
+    for requested_category in categories:
+        # Each task and each invocation of a task uploads its own segment of the category
+        object_prefix = requested_category if task is None else f"{requested_category}_{task}"
+        object_name = f"{object_prefix}_geoapify_response.json" if segment == 0 else f"{object_prefix}_{segment}_geoapify_response.json"
+        uploads[requested_category] = start_multipart_upload(client, get_object_key(object_name, run_date))
+    seen_ids = {requested_category: set() for requested_category in categories}
+    # Records found in each tile per category, counted before de-duplication
+    tile_counts = {requested_category: [0] * len(tasks) for requested_category in categories}
+    write_lock = threading.Lock()
+
+    def write_page(tile_index, records):
+        with write_lock:
+            entries = {requested_category: [] for requested_category in categories}
+            for id, record in records:
+                tiling_stats["records"] += 1
+                if regions:
+                    record["regions"] = regions
+                record_categories = get_record_categories(record, categories)
+                if not record_categories:
+                    tiling_stats["unmatched"] += 1
+                for requested_category in record_categories:
+                    tile_counts[requested_category][tile_index] += 1
+                    # A POI on the edge shared by two tiles is returned by both
+                    if id in seen_ids[requested_category]:
+                        tiling_stats["duplicates"] += 1
+                        continue
+                    seen_ids[requested_category].add(id)
+                    entries[requested_category].append(json.dumps({id: record}, separators=(",", ":"))[1:-1])
+            for requested_category, category_entries in entries.items():
+                if category_entries:
+                    upload = uploads[requested_category]
+                    separator = "," if upload["entries"] else ""
+                    write_multipart_upload(client, upload, separator + ",".join(category_entries))
+                    upload["entries"] += len(category_entries)
 
-        except Exception as e:
-            print(e)
-            query_done = True
+    def should_stop():
+        return context is not None and context.get_remaining_time_in_millis() < CONTINUATION_MARGIN_MS
 
-    file_path = f"{file_dir}/{category}_geoapify_response.json"
-    # Write the records to a JSON file
-    with open(file_path, 'w+') as file:
-        json.dump(geoapify_response_dict, file, indent=4)
+    def fetch_task(tile_index):
+        tile_task = tasks[tile_index]
+        return fetch_tile(category, tile_task[:4], geoapify_api_key, lambda records: write_page(tile_index, records), tile_task[4], should_stop)
 
-    # Upload JSON file to S3
-    upload_to_s3(client, file_path, f"{category}_geoapify_response.json")
+    try:
+        for upload in uploads.values():
+            write_multipart_upload(client, upload, "{")
+        # Fetch the tiles concurrently, a request that still fails after its retries fails the invocation
+        # rather than silently leaving out the records of a tile
+        with ThreadPoolExecutor(max_workers=TILE_WORKERS) as executor:
+            results = list(executor.map(fetch_task, range(len(tasks))))
+        for upload in uploads.values():
+            write_multipart_upload(client, upload, "}")
+            complete_multipart_upload(client, upload)
+    except Exception:
+        # Leave no incomplete upload behind, its parts are stored and billed until aborted
+        for upload in uploads.values():
+            if not upload["completed"]:
+                client.abort_multipart_upload(Bucket=upload["bucket"], Key=upload["key"], UploadId=upload["upload_id"])
+        raise
+
+    remaining_tasks = [[*tile_task[:4], offset] for tile_task, (offset, count) in zip(tasks, results) if offset is not None]
+    tiling_stats["continued_tiles"] = len(remaining_tasks)
+
+    # Save the records found per tile, used by the invoker to estimate the size of the next run
+    for requested_category, upload in uploads.items():
+        stats_name = upload["key"].split("/")[-1][:-len("_geoapify_response.json")]
+        category_tile_counts = [[*tile_task[:4], count] for tile_task, count in zip(tasks, tile_counts[requested_category])]
+        upload_stats(client, f"{stats_name}.json", requested_category, category_tile_counts, run_date)
+
+    print(f"Tiling: {tiling_stats}")
+    print(f"Request latency: {http_client.get_latency_stats()}")
+
+    # Continue the tiles that were not finished in a new invocation, only after their pages so far are uploaded
+    if remaining_tasks:
+        event = {
+            "category": category,
+            "lon1": lon1,
+            "lat1": lat1,
+            "lon2": lon2,
+            "lat2": lat2,
+            "task": task,
+            "api_key_index": api_key_index,
+            "regions": regions,
+            "run_date": run_date,
+            "continuation": {"tasks": remaining_tasks, "segment": segment + 1},
+        }
+        invoke_continuation(context.function_name, event)
+        return f"Output segment {segment} uploaded to S3 bucket, {len(remaining_tasks)} tiles continued in a new invocation"
 
     message = "Output generated and files uploaded to S3 bucket"
 
     return message
 
-def upload_to_s3(client, file_path, object_name):
+def get_record_categories(record, categories):
+    """
+    Get the requested categories a record belongs to, a record of a subcategory such as natural.beach belongs to natural
+    Expected input:
+    - record: the record formatted to poi_data_schema
+    - categories: the categories of the query
+    Expected output:
+    - the list of categories of the query the record belongs to
+    """
+    if len(categories) == 1:
+        return categories
+    record_categories = record.get("categories") or []
+    return [category for category in categories if any(value == category or value.startswith(f"{category}.") for value in record_categories)]
+
+def get_geoapify_api_key(api_key_index=0):
+    """
+    Get one of the Geoapify API keys, from GEOAPIFY_API_KEYS when several keys are set
+    """
+    api_keys = [api_key.strip() for api_key in os.environ.get("GEOAPIFY_API_KEYS", "").split(",") if api_key.strip()]
+    if api_keys:
+        if not 0 <= api_key_index < len(api_keys):
+            raise ValueError(f"Geoapify API key {api_key_index} requested but GEOAPIFY_API_KEYS holds {len(api_keys)} keys")
+        return api_keys[api_key_index]
+
+    # Spending another key's quota with the single key would exceed its credits
+    if api_key_index != 0:
+        raise ValueError(f"Geoapify API key {api_key_index} requested but GEOAPIFY_API_KEYS is not set, only GEOAPIFY_API_KEY is available")
+    return os.environ["GEOAPIFY_API_KEY"]
+
+def invoke_continuation(function_name, event):
+    """
+    Invoke the scraper asynchronously to continue the scrape
+    """
+    response = boto3.client("lambda").invoke(
+        FunctionName=function_name,
+        InvocationType="Event",
+        Payload=json.dumps(event).encode("utf-8"),
+    )
+    if response["StatusCode"] != 202:
+        raise Exception(f"Failed to invoke the continuation of the scrape: status {response['StatusCode']}")
+
+def plan_tiles(category, rect, geoapify_api_key, max_pages=MAX_TILE_PAGES, min_degrees=MIN_TILE_DEGREES):
+    """
+    Split a rectangle into quadrants recursively until the results of each tile fit within a few pages
+    Expected input:
+    - category: the Geoapify category
+    - rect: the (lon1, lat1, lon2, lat2) rectangle to cover
+    - geoapify_api_key: the Geoapify API key
+    - max_pages: the largest number of pages of a tile
+    - min_degrees: the smallest width or height of a tile that is split further
+    Expected output:
+    - the list of (lon1, lat1, lon2, lat2) tiles covering the rectangle
+    """
+    max_records = max_pages * PAGE_SIZE
+    tiles = []
+    pending = [rect]
+
+    # Probe the tiles of each level of the quadtree concurrently
+    with ThreadPoolExecutor(max_workers=TILE_WORKERS) as executor:
+        while pending:
+            exceeded = list(executor.map(lambda tile: has_more_records(category, tile, geoapify_api_key, max_records), pending))
+            tiling_stats["probes"] += len(pending)
+
+            next_pending = []
+            for tile, tile_exceeded in zip(pending, exceeded):
+                lon1, lat1, lon2, lat2 = tile
+                if tile_exceeded and abs(lon2 - lon1) > min_degrees and abs(lat2 - lat1) > min_degrees:
+                    next_pending.extend(split_tile(tile))
+                else:
+                    if tile_exceeded:
+                        print(f"Tile {tile} has more than {max_records} records but is too small to split")
+                    tiles.append(tile)
+            pending = next_pending
+
+    return tiles
+
+def has_more_records(category, tile, geoapify_api_key, max_records):
+    """
+    Check whether a tile has more than max_records results, by requesting a single record past them
+    """
+    lon1, lat1, lon2, lat2 = tile
+    params = {
+        "categories": category,
+        "filter": f"rect:{lon1},{lat1},{lon2},{lat2}",
+        "limit": 1,
+        "offset": max_records,
+        "apiKey": geoapify_api_key,
+    }
+    return len(http_client.get_json(GEOAPIFY_PLACES_URL, params)["features"]) > 0
+
+def split_tile(tile):
+    """
+    Split a tile into its four quadrants
+    """
+    lon1, lat1, lon2, lat2 = tile
+    lon_mid = (lon1 + lon2) / 2
+    lat_mid = (lat1 + lat2) / 2
+    return [
+        (lon1, lat1, lon_mid, lat_mid),
+        (lon_mid, lat1, lon2, lat_mid),
+        (lon1, lat_mid, lon_mid, lat2),
+        (lon_mid, lat_mid, lon2, lat2),
+    ]
+
+def fetch_tile(category, tile, geoapify_api_key, write_page, offset=0, should_stop=None):
+    """
+    Get the records of a category within a tile, page by page
+    Expected input:
+    - category: the Geoapify category
+    - tile: the (lon1, lat1, lon2, lat2) rectangle to fetch
+    - geoapify_api_key: the Geoapify API key
+    - write_page: called with the (place_id, record) pairs of each page as it arrives, the records formatted to poi_data_schema
+    - offset: the offset of the first page to fetch
+    - should_stop: optional function checked before each page, to stop fetching before the invocation times out
+    Expected output:
+    - the offset of the next page if fetching stopped early, None once every record of the tile is written
+    - the number of records written
+    """
+    lon1, lat1, lon2, lat2 = tile
+    count = 0
+
+    while True:
+        if should_stop is not None and should_stop():
+            return offset, count
+
+        params = {
+            "categories": category,
+            "filter": f"rect:{lon1},{lat1},{lon2},{lat2}",
+            "limit": PAGE_SIZE,
+            "offset": offset,
+            "apiKey": geoapify_api_key,
+        }
+        features = http_client.get_json(GEOAPIFY_PLACES_URL, params)["features"]
+
+        write_page([(record["properties"]["place_id"], poi_schema_formatter(record["properties"], poi_data_schema)) for record in features])
+        count += len(features)
+
+        # A page that is not full is the last one
+        if len(features) < PAGE_SIZE:
+            return None, count
+        offset += PAGE_SIZE
+
+def get_object_key(object_name, run_date=None):
+    # Get current date to store data under this key, unless the run started on another date
+    if run_date is None:
+        run_date = datetime.today().strftime('%Y-%m-%d')
+    return f"poi-api/{run_date}/geoapify/{object_name}"
+
+def upload_stats(client, object_name, category, tile_counts, run_date=None):
+    """
+    Upload the number of records found in each tile by the invocation
+    Expected input:
+    - object_name: the name of the stats object, under the stats directory of the Geoapify outputs
+    - category: the Geoapify category
+    - tile_counts: the list of [lon1, lat1, lon2, lat2, count] of each tile
+    - run_date: the date of the run, today if not set
+    """
+    stats = {"category": category, "tiles": tile_counts}
+    client.put_object(Bucket="stonehenge-fyp", Key=get_object_key(f"stats/{object_name}", run_date), Body=json.dumps(stats).encode("utf-8"))
+
+def start_multipart_upload(client, object_key, bucket="stonehenge-fyp"):
+    """
+    Start a multipart upload written to in pieces with write_multipart_upload
+    Expected output:
+    - the state of the upload, with the part being filled and the parts already uploaded
+    """
+    response = client.create_multipart_upload(Bucket=bucket, Key=object_key, ContentType="application/json")
+    return {"bucket": bucket, "key": object_key, "upload_id": response["UploadId"], "buffer": bytearray(), "parts": [], "entries": 0, "completed": False}
+
+def write_multipart_upload(client, upload, text):
+    """
+    Add text to a multipart upload, uploading a part whenever enough data is buffered
+    """
+    upload["buffer"] += text.encode("utf-8")
+    if len(upload["buffer"]) >= UPLOAD_PART_BYTES:
+        upload_part(client, upload)
+
+def complete_multipart_upload(client, upload):
+    """
+    Upload the remaining data as the last part and complete the multipart upload
+    """
+    upload_part(client, upload)
+    client.complete_multipart_upload(Bucket=upload["bucket"], Key=upload["key"], UploadId=upload["upload_id"], MultipartUpload={"Parts": upload["parts"]})
+    upload["completed"] = True
 
-    # Get current date to store data under this key
-    current_date = datetime.today().strftime('%Y-%m-%d')
-    final_key = f"poi-api/{current_date}/geoapify/{object_name}"
+def upload_part(client, upload):
+    part_number = len(upload["parts"]) + 1
+    response = client.upload_part(Bucket=upload["bucket"], Key=upload["key"], UploadId=upload["upload_id"], PartNumber=part_number, Body=bytes(upload["buffer"]))
+    upload["parts"].append({"ETag": response["ETag"], "PartNumber": part_number})
+    upload["buffer"] = bytearray()
 
-    with open(file_path, "rb") as f:
-        client.upload_fileobj(f, "stonehenge-fyp", final_key)
-        
 def poi_schema_formatter(input_dict, schema):
     """
     Formats the input dictionary to match the schema
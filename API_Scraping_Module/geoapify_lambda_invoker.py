@@ -1,9 +1,40 @@
+import os
 import json
+import math
 import boto3
+from botocore.exceptions import ClientError
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Make sure AWS Credentials are set - AWS_ACCESS_KEY_ID + AWS_SECRET_ACCESS_KEY
 client = boto3.client("lambda")
 
+# The bounding box is split into GRID_SIZE x GRID_SIZE tiles, each scraped by its own invocation per category
+GRID_SIZE = int(os.environ.get("GRID_SIZE", "1"))
+# Invocations made at once, the scrapers running at once are capped by the reserved concurrency of the scraper
+DISPATCH_WORKERS = int(os.environ.get("DISPATCH_WORKERS", "8"))
+
+# Geoapify API keys of the scraper (GEOAPIFY_API_KEYS), and the credits each can spend per run
+API_KEY_COUNT = int(os.environ.get("GEOAPIFY_API_KEY_COUNT", "1"))
+API_KEY_CREDITS = int(os.environ.get("GEOAPIFY_API_KEY_CREDITS", "3000"))
+# Number of keys actually set in the scraper, unset when run locally
+API_KEYS_PROVIDED = os.environ.get("GEOAPIFY_API_KEYS_PROVIDED")
+# Geoapify charges 1 credit per 20 places returned, and at least 1 credit per request
+RECORDS_PER_CREDIT = 20
+# The scraper probes a tile with a single record request, and splits it into quadrants past this many records
+TILE_MAX_RECORDS = int(os.environ.get("MAX_TILE_PAGES", "4")) * 500
+# Records assumed for a category without stats from a previous run
+DEFAULT_ESTIMATED_RECORDS = 2000
+
+# Categories with fewer records than SPARSE_CATEGORY_RECORDS in the previous run are scraped together
+# in one query of up to COALESCED_MAX_RECORDS records when COALESCE_SPARSE_CATEGORIES is set
+COALESCE_SPARSE_CATEGORIES = os.environ.get("COALESCE_SPARSE_CATEGORIES", "false").lower() == "true"
+SPARSE_CATEGORY_RECORDS = 500
+COALESCED_MAX_RECORDS = 2000
+
+# Tasks that did not fit within the credits of the API keys, dispatched first by the next run
+DEFERRED_TASKS_KEY = "poi-api/geoapify-deferred-tasks.json"
+
 # Categories obtained from the following link: https://apidocs.geoapify.com/docs/places/#categories
 
 # # Categories we used, as of 2023-02-21
@@ -37,46 +68,353 @@ client = boto3.client("lambda")
 
 def handler(event, context):
     message = ""
-    categories = event["categories"]
-    lon1 = event["lon1"]
-    lat1 = event["lat1"]
-    lon2 = event["lon2"]
-    lat2 = event["lat2"]
+    s3_client = boto3.client("s3")
+
+    # Planning against credits of keys the scraper does not have would overspend the keys it has
+    if API_KEYS_PROVIDED is not None and int(API_KEYS_PROVIDED) != API_KEY_COUNT:
+        raise ValueError(f"GEOAPIFY_API_KEY_COUNT is {API_KEY_COUNT} but the scraper has {API_KEYS_PROVIDED} Geoapify API keys")
+
+    # Tasks deferred by the previous run go first, with the date of their run
+    previous_tasks = load_deferred_tasks(s3_client)
+
+    # {"deferred": true} only dispatches the deferred tasks, once the API keys have credits again
+    if event.get("deferred"):
+        region_tiles = []
+        tasks = []
+    else:
+        # Several named regions may be scraped in one run, their overlaps are scraped once
+        if "regions" in event:
+            region_tiles = plan_region_tiles(event["regions"])
+        else:
+            rect = (float(event["lon1"]), float(event["lat1"]), float(event["lon2"]), float(event["lat2"]))
+            region_tiles = [{"rect": rect, "regions": None}]
+
+        # Estimate the records of each category x tile task from the stats of the previous run
+        category_stats = load_category_stats(s3_client)
+        tasks = plan_tasks(event["categories"], region_tiles, category_stats)
+        run_date = datetime.today().strftime("%Y-%m-%d")
+        for task in tasks:
+            task["run_date"] = run_date
+
+    # Tasks that do not fit within the credits of any API key are saved for the next run
+    dispatched_tasks, deferred_tasks, key_credits = assign_api_keys(previous_tasks, API_KEY_COUNT, API_KEY_CREDITS)
+    planned_dispatched_tasks, planned_deferred_tasks, key_credits = assign_api_keys(tasks, API_KEY_COUNT, API_KEY_CREDITS, key_credits)
+    dispatched_tasks += planned_dispatched_tasks
+    deferred_tasks += planned_deferred_tasks
+    save_deferred_tasks(s3_client, deferred_tasks)
+    if deferred_tasks:
+        print(f"WARNING: {len(deferred_tasks)} tasks do not fit within the credits of the API keys and are missing from this run. "
+              f"They are saved to {DEFERRED_TASKS_KEY}, invoke the function with {{\"deferred\": true}} once the keys have credits again")
+
+    with ThreadPoolExecutor(max_workers=DISPATCH_WORKERS) as executor:
+        results = list(executor.map(main, dispatched_tasks))
+
+    for result, succeeded in results:
+        message += result
+
+    report = {
+        "region_tiles": len(region_tiles),
+        "previously_deferred_tasks": len(previous_tasks),
+        "planned_tasks": len(tasks),
+        "dispatched_tasks": sum(succeeded for result, succeeded in results),
+        "failed_tasks": sum(not succeeded for result, succeeded in results),
+        "deferred_tasks": [{"category": task["category"], "task": task["task"], "run_date": task["run_date"]} for task in deferred_tasks],
+        "planned_records": sum(task["estimated_records"] for task in previous_tasks + tasks),
+        "dispatched_records": sum(task["estimated_records"] for task, (result, succeeded) in zip(dispatched_tasks, results) if succeeded),
+        "credits_per_api_key": key_credits,
+    }
+    print(f"Dispatch report: {report}")
+
+    return {"message": message, "report": report}
+
+def plan_region_tiles(regions):
+    """
+    Normalise named regions that may overlap into tiles that do not, each tagged with every region covering it
+    Expected input:
+    - regions: a list of dictionaries with the 'name' and the 'lon1', 'lat1', 'lon2' and 'lat2' corners of each region
+    Expected output:
+    - a list of dictionaries with the (lon1, lat1, lon2, lat2) 'rect' of each tile and the names of its 'regions'
+    """
+    boxes = []
+    for region in regions:
+        lons = (float(region["lon1"]), float(region["lon2"]))
+        lats = (float(region["lat1"]), float(region["lat2"]))
+        boxes.append((region["name"], min(lons), min(lats), max(lons), max(lats)))
+
+    # The edges of every region split the area into a grid of cells, each within or outside each region
+    lon_edges = sorted({box[1] for box in boxes} | {box[3] for box in boxes})
+    lat_edges = sorted({box[2] for box in boxes} | {box[4] for box in boxes})
+
+    tiles = []
+    # Runs of cells with the same regions in the previous column, extended while the next column has the same run
+    open_tiles = {}
+    for col in range(len(lon_edges) - 1):
+        runs = []
+        for row in range(len(lat_edges) - 1):
+            names = tuple(name for name, west, south, east, north in boxes
+                          if west <= lon_edges[col] and lon_edges[col + 1] <= east and south <= lat_edges[row] and lat_edges[row + 1] <= north)
+            if runs and runs[-1][2] == names and runs[-1][1] == row:
+                runs[-1] = (runs[-1][0], row + 1, names)
+            else:
+                runs.append((row, row + 1, names))
+
+        next_open_tiles = {}
+        for run in runs:
+            # Cells outside every region are not scraped
+            if not run[2]:
+                continue
+            next_open_tiles[run] = open_tiles.pop(run, col)
+        for (start_row, end_row, names), start_col in open_tiles.items():
+            tiles.append({"rect": (lon_edges[start_col], lat_edges[start_row], lon_edges[col], lat_edges[end_row]), "regions": list(names)})
+        open_tiles = next_open_tiles
+
+    for (start_row, end_row, names), start_col in open_tiles.items():
+        tiles.append({"rect": (lon_edges[start_col], lat_edges[start_row], lon_edges[-1], lat_edges[end_row]), "regions": list(names)})
+
+    return tiles
 
+def plan_tasks(categories, region_tiles, category_stats, grid_size=GRID_SIZE):
+    """
+    Plan the scraper invocations of a run, one per category and tile of the bounding boxes
+    Expected input:
+    - categories: the list of Geoapify categories
+    - region_tiles: the list of region tiles from plan_region_tiles, each with its (lon1, lat1, lon2, lat2) 'rect' and 'regions'
+    - category_stats: the records found per tile by the previous run, from load_category_stats
+    - grid_size: the number of tiles along each side of each region tile
+    Expected output:
+    - a list of tasks, each with the scraper parameters and the estimated records and credits
+    """
+    tasks = []
+
+    if COALESCE_SPARSE_CATEGORIES:
+        category_groups = coalesce_categories(categories, category_stats)
+    else:
+        category_groups = [[category] for category in categories]
+
+    for category_group in category_groups:
+        # The scraper splits the records of a comma separated query back per category
+        category = ",".join(category_group)
+        stats_tiles = [tile for group_category in category_group for tile in category_stats.get(group_category, [])]
+        for tile_index, region_tile in enumerate(region_tiles):
+            lon1, lat1, lon2, lat2 = region_tile["rect"]
+            estimates, stats_tile_counts = estimate_tile_records(stats_tiles, region_tile["rect"], grid_size)
+            for row in range(grid_size):
+                for col in range(grid_size):
+                    estimated_records = estimates[row][col]
+                    # A single tile keeps the output name of the category
+                    task_names = []
+                    if len(region_tiles) > 1:
+                        task_names.append(f"t{tile_index}")
+                    if grid_size > 1:
+                        task_names.append(f"r{row}c{col}")
+                    tasks.append({
+                        "category": category,
+                        "lon1": lon1 + (lon2 - lon1) * col / grid_size,
+                        "lat1": lat1 + (lat2 - lat1) * row / grid_size,
+                        "lon2": lon1 + (lon2 - lon1) * (col + 1) / grid_size,
+                        "lat2": lat1 + (lat2 - lat1) * (row + 1) / grid_size,
+                        "task": "".join(task_names) or None,
+                        "regions": region_tile["regions"],
+                        "estimated_records": estimated_records,
+                        # The pages are charged by the places returned, and the tiling probes by request
+                        "estimated_credits": math.ceil(estimated_records / RECORDS_PER_CREDIT) + estimate_probe_credits(estimated_records, stats_tile_counts[row][col]),
+                    })
+
+    return tasks
+
+def coalesce_categories(categories, category_stats, sparse_records=SPARSE_CATEGORY_RECORDS, max_records=COALESCED_MAX_RECORDS):
+    """
+    Group the sparse categories into combined queries, by the records found in the previous run
+    Expected input:
+    - categories: the list of Geoapify categories
+    - category_stats: the records found per tile by the previous run, from load_category_stats
+    - sparse_records: the number of records under which a category is coalesced
+    - max_records: the largest number of records of a combined query
+    Expected output:
+    - a list of groups of categories, each scraped in one query
+    """
+    category_groups = []
+    sparse_categories = []
     for category in categories:
-        params = {
-            "category": category,
-            "lon1": lon1,
-            "lat1": lat1,
-            "lon2": lon2,
-            "lat2": lat2
-        }
-        message += main(params)
+        # A category without stats may be dense, it keeps its own query
+        if category not in category_stats:
+            category_groups.append([category])
+            continue
+        records = sum(tile[4] for tile in category_stats[category])
+        if records < sparse_records:
+            sparse_categories.append((records, category))
+        else:
+            category_groups.append([category])
+
+    # Place each category in the first group it fits in, the largest first
+    coalesced_groups = []
+    for records, category in sorted(sparse_categories, reverse=True):
+        for group in coalesced_groups:
+            if group["records"] + records <= max_records:
+                group["records"] += records
+                group["categories"].append(category)
+                break
+        else:
+            coalesced_groups.append({"records": records, "categories": [category]})
+
+    return category_groups + [group["categories"] for group in coalesced_groups]
+
+def estimate_tile_records(stats_tiles, rect, grid_size):
+    """
+    Estimate the records of a category in each tile of the grid
+    Expected input:
+    - stats_tiles: the [lon1, lat1, lon2, lat2, count] tiles of the category from the previous run, None if there are none
+    - rect: the (lon1, lat1, lon2, lat2) bounding box
+    - grid_size: the number of tiles along each side of the bounding box
+    Expected output:
+    - a grid_size x grid_size list of estimated records, indexed by row and column
+    - a grid_size x grid_size list of the previous tiles counted in each grid tile
+    """
+    lon1, lat1, lon2, lat2 = rect
+    tile_counts = [[0] * grid_size for row in range(grid_size)]
+    if not stats_tiles:
+        per_tile = math.ceil(DEFAULT_ESTIMATED_RECORDS / grid_size ** 2)
+        return [[per_tile] * grid_size for row in range(grid_size)], tile_counts
+
+    estimates = [[0] * grid_size for row in range(grid_size)]
+    for tile_lon1, tile_lat1, tile_lon2, tile_lat2, count in stats_tiles:
+        # Count the records of a previous tile in the grid tile holding its centre
+        lon_fraction = ((tile_lon1 + tile_lon2) / 2 - lon1) / (lon2 - lon1)
+        lat_fraction = ((tile_lat1 + tile_lat2) / 2 - lat1) / (lat2 - lat1)
+        if 0 <= lon_fraction <= 1 and 0 <= lat_fraction <= 1:
+            col = min(int(lon_fraction * grid_size), grid_size - 1)
+            row = min(int(lat_fraction * grid_size), grid_size - 1)
+            estimates[row][col] += count
+            tile_counts[row][col] += 1
+
+    return estimates, tile_counts
+
+def estimate_probe_credits(estimated_records, previous_tiles=0, max_records=TILE_MAX_RECORDS):
+    """
+    Estimate the credits spent by the scraper probing a task for its quadtree tiles, one credit per probe
+    Expected input:
+    - estimated_records: the estimated records of the task
+    - previous_tiles: the number of tiles the previous run split the task into, 0 if unknown
+    - max_records: the records of a tile past which the scraper splits it
+    Expected output:
+    - the estimated number of probe requests
+    """
+    # Records spread evenly need every level of quadrants down to tiles within max_records
+    probes, level_tiles = 1, 1
+    while estimated_records > level_tiles * max_records:
+        level_tiles *= 4
+        probes += level_tiles
 
-    return {"message": message}
+    # A quadtree with n tiles has (4n - 1) / 3 nodes, each probed once, and clustered records split deeper than even ones
+    return max(probes, math.ceil((4 * previous_tiles - 1) / 3))
+
+def assign_api_keys(tasks, api_key_count=API_KEY_COUNT, api_key_credits=API_KEY_CREDITS, key_credits=None):
+    """
+    Spread the tasks over the API keys within the credits of each key, the largest tasks first
+    Expected input:
+    - tasks: the tasks from plan_tasks
+    - api_key_count: the number of Geoapify API keys of the scraper
+    - api_key_credits: the credits each key can spend
+    - key_credits: the credits already spent on each key by other tasks of the run, none if not set
+    Expected output:
+    - the tasks to dispatch, each with the index of its API key
+    - the tasks deferred as no key has the credits left for them
+    - the estimated credits spent on each key
+    """
+    key_credits = [0] * api_key_count if key_credits is None else list(key_credits)
+    dispatched_tasks, deferred_tasks = [], []
+
+    for task in sorted(tasks, key=lambda task: task["estimated_credits"], reverse=True):
+        # Use the key with the most credits left
+        api_key_index = min(range(api_key_count), key=lambda index: key_credits[index])
+        if key_credits[api_key_index] + task["estimated_credits"] > api_key_credits:
+            deferred_tasks.append(task)
+            continue
+        key_credits[api_key_index] += task["estimated_credits"]
+        dispatched_tasks.append(dict(task, api_key_index=api_key_index))
+
+    return dispatched_tasks, deferred_tasks, key_credits
+
+def load_deferred_tasks(s3_client, bucket="stonehenge-fyp"):
+    """
+    Load the tasks deferred by the previous run
+    Expected output:
+    - the list of deferred tasks, empty if there are none
+    """
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=DEFERRED_TASKS_KEY)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return []
+        raise
+    tasks = json.loads(response["Body"].read())
+    print(f"Dispatching {len(tasks)} tasks deferred by a previous run first")
+    return tasks
+
+def save_deferred_tasks(s3_client, tasks, bucket="stonehenge-fyp"):
+    """
+    Save the tasks deferred by the run for the next run, replacing the tasks it has taken over
+    Expected input:
+    - tasks: the deferred tasks, the saved tasks are deleted if there are none
+    """
+    if tasks:
+        s3_client.put_object(Bucket=bucket, Key=DEFERRED_TASKS_KEY, Body=json.dumps(tasks).encode("utf-8"))
+    else:
+        s3_client.delete_object(Bucket=bucket, Key=DEFERRED_TASKS_KEY)
+
+def load_category_stats(s3_client, bucket="stonehenge-fyp"):
+    """
+    Load the records found per tile by the scrapers of the latest run with stats
+    Expected output:
+    - a dictionary of category to the list of [lon1, lat1, lon2, lat2, count] of its tiles
+    """
+    # The runs are stored under poi-api/{date}/, the latest date is last
+    response = s3_client.list_objects_v2(Bucket=bucket, Prefix="poi-api/", Delimiter="/")
+    run_prefixes = sorted((prefix["Prefix"] for prefix in response.get("CommonPrefixes", [])), reverse=True)
+
+    for run_prefix in run_prefixes:
+        paginator = s3_client.get_paginator("list_objects_v2")
+        stats_keys = [obj["Key"] for page in paginator.paginate(Bucket=bucket, Prefix=f"{run_prefix}geoapify/stats/") for obj in page.get("Contents", [])]
+        if not stats_keys:
+            continue
+
+        # A category scraped in several tasks or invocations has one stats object each
+        category_stats = {}
+        for key in stats_keys:
+            stats = json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read())
+            category_stats.setdefault(stats["category"], []).extend(stats["tiles"])
+        print(f"Estimating records from the stats of {run_prefix}")
+        return category_stats
+
+    return {}
 
 def main(params):
 
+    # Only the scraper parameters are sent, the estimates stay in the invoker
+    payload = {key: params[key] for key in ("category", "lon1", "lat1", "lon2", "lat2", "task", "regions", "api_key_index", "run_date") if params.get(key) is not None}
+
     # Data will be stored in S3 bucket - stonehenge-fyp
     response = client.invoke(
                 FunctionName='Geoapify-API-Scraper',
                 InvocationType='Event',
                 LogType='None',
-                Payload=json.dumps(params).encode("utf-8"),
+                Payload=json.dumps(payload).encode("utf-8"),
             )
     
     status = response["StatusCode"]
     category = params["category"]
+    if params.get("task") is not None:
+        category = f"{category} ({params['task']})"
 
     # Return message on successful Lambda invocation
     if status == 202:
         result = f"Successfully invoked Geoapify Lambda function with {category} category \n"
         print(result)
-        return result
+        return result, True
     
     result = f"Failed to invoke Geoapify Lambda function with {category} category \n"
     print(result)
-    return result
+    return result, False
 
 # Local Invocation
 if __name__ == "__main__":
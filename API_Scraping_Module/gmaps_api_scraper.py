@@ -1,11 +1,41 @@
 import re
-import requests
 import json
+import time
+import hashlib
 import boto3
 import os
-from requests.structures import CaseInsensitiveDict
+import threading
+import uuid
+import requests
+import http_client
+from botocore.exceptions import ClientError
 from datetime import datetime
-from urllib.parse import urlencode as encode
+from concurrent.futures import ThreadPoolExecutor
+
+# Records enriched at once, and the Google Maps API requests per second allowed across every scraper running at once
+ENRICH_WORKERS = int(os.environ.get("ENRICH_WORKERS", "8"))
+GOOGLE_REQUESTS_PER_SECOND = float(os.environ.get("GOOGLE_REQUESTS_PER_SECOND", "20"))
+# The rate limit is kept per container, so each of the scrapers capped by the reserved concurrency gets an even share
+GMAPS_SCRAPER_CONCURRENCY = int(os.environ.get("GMAPS_SCRAPER_CONCURRENCY", "1"))
+# Google Maps API statuses that may succeed when the message is received again
+GOOGLE_RETRY_STATUSES = {"OVER_QUERY_LIMIT", "UNKNOWN_ERROR"}
+
+# Geoapify record to Google place id resolutions, stored in S3 or in a local file when PLACE_ID_CACHE_PATH is set
+# In S3, each invocation adds its own objects under the shard of each resolution, merged when the cache is read,
+# so that concurrent invocations never write the same object
+PLACE_ID_CACHE_PREFIX = "poi-api/place-id-cache/"
+PLACE_ID_CACHE_SHARDS = 16
+# A shard with more objects than this is compacted into one object by the invocation saving to it
+PLACE_ID_CACHE_COMPACT_OBJECTS = 20
+PLACE_ID_CACHE_PATH = os.environ.get("PLACE_ID_CACHE_PATH")
+# Text searches without results are cached for less time, as the place may be listed on Google Maps later
+PLACE_ID_TTL_SECONDS = 90 * 24 * 60 * 60
+NO_RESULTS_TTL_SECONDS = 14 * 24 * 60 * 60
+
+# Resolutions kept across invocations of a warm Lambda container, and the ones to save at the end of the invocation
+place_id_cache = {"entries": {}, "loaded_keys": set(), "shard_keys": {}, "pending": {}}
+place_id_cache_stats = {"hits": 0, "no_results_hits": 0, "misses": 0}
+place_id_cache_lock = threading.Lock()
 
 # Schema for POI Data formatted
 poi_data_schema = {
@@ -34,41 +64,90 @@ def handler(event, context):
     messages = event["Records"]
 
     records = {}
+    message_ids = {}
+    failed_message_ids = []
     for message in messages:
-        body = json.loads(message["body"])
+        # A message that cannot be read is returned to the queue on its own
+        try:
+            body = json.loads(message["body"])
+        except Exception as e:
+            print(f"Message {message['messageId']} could not be read: {e}")
+            failed_message_ids.append(message["messageId"])
+            continue
         for key, value in body.items():
             records[key] = value
+            message_ids[key] = message["messageId"]
+
+    http_client.reset_latency_stats()
+    place_id_cache_stats.update({"hits": 0, "no_results_hits": 0, "misses": 0})
+    message, failed = main(records, message_ids=message_ids)
+    failed_message_ids.extend(failed)
 
-    message = main(records)
+    # Only the failed messages are returned to the queue, the rest of the batch is deleted
+    batch_item_failures = [{"itemIdentifier": message_id} for message_id in failed_message_ids]
 
-    return {"message": message}
+    return {"message": message, "latency_stats": http_client.get_latency_stats(), "place_id_cache_stats": dict(place_id_cache_stats), "batchItemFailures": batch_item_failures}
 
-def main(records, file_dir="/tmp"):
+def main(records, file_dir="/tmp", message_ids=None):
     # Retrieve Google Maps API Key from environment variables
     google_api_key = os.environ["GOOGLE_API_KEY"]
 
     s3_client = boto3.client("s3")
 
     record_dict = records
-    file_name = ""
+    if not record_dict:
+        return "No records to process", []
 
-    # Make API request to Google Places (Place Search + Place Details)
-    for id in record_dict.keys():
-        record = record_dict[id]
-        file_name += id
-        try:
-            term = record["name"]
-            lon, lat = record["lon"], record["lat"]
-            google_response = google_place_details(term, lon, lat, google_api_key)
-            relavant_record = poi_schema_formatter(google_response["result"], poi_data_schema)
-        except Exception as e:
-            print(e)
-            relavant_record = {}
-        
+    # Name the output after the records, so that a redelivered batch is recognised and skipped
+    hashed_file_name = generate_file_name(record_dict.keys())
+    if object_exists(s3_client, get_object_key(f"{hashed_file_name}.json")):
+        print(f"Batch {hashed_file_name} already processed, skipping")
+        return "Batch already processed", []
+
+    # Refresh the place id resolutions saved by other invocations, the records are enriched without them on failure
+    try:
+        load_place_id_cache(s3_client)
+    except Exception as e:
+        print(f"Place id cache not loaded: {e}")
+
+    # Make API request to Google Places (Place Search + Place Details) for several records at once
+    http_client.set_rate_limit(GOOGLE_REQUESTS_PER_SECOND / GMAPS_SCRAPER_CONCURRENCY)
+    ids = list(record_dict.keys())
+    with ThreadPoolExecutor(max_workers=ENRICH_WORKERS) as executor:
+        # map gives the results back in the order of the records
+        relavant_records = list(executor.map(lambda id: enrich_record(id, record_dict[id], google_api_key), ids))
+
+    # The Google Maps API calls are already paid for, a failed cache save must not fail the batch
+    try:
+        save_place_id_cache(s3_client)
+    except Exception as e:
+        print(f"Place id cache not saved: {e}")
+    print(f"Place id cache: {place_id_cache_stats}")
+
+    # A record that could not be enriched returns its whole message to the queue, or only itself when invoked directly
+    failed_ids = [id for id, relavant_record in zip(ids, relavant_records) if relavant_record is None]
+    if message_ids is None:
+        failed_message_ids = failed_ids
+        excluded_ids = set(failed_ids)
+    else:
+        failed_message_ids = list(dict.fromkeys(message_ids[id] for id in failed_ids))
+        excluded_ids = set(id for id in ids if message_ids[id] in failed_message_ids)
+
+    for id, relavant_record in zip(ids, relavant_records):
         # Combine the results
-        record_dict[id].update(relavant_record)
+        if relavant_record is not None:
+            record_dict[id].update(relavant_record)
+
+    if failed_message_ids:
+        # Leave out the failed records, they are processed when their messages are received again
+        record_dict = {id: record for id, record in record_dict.items() if id not in excluded_ids}
+        print(f"{len(failed_message_ids)} {'records' if message_ids is None else 'messages'} failed and are left out of the output")
+        if not record_dict:
+            return "No records enriched", failed_message_ids
+        hashed_file_name = generate_file_name(record_dict.keys())
     
-    hashed_file_name = hash(file_name)
+    print(f"Request latency: {http_client.get_latency_stats()}")
+
     file_path = f"{file_dir}/{hashed_file_name}.json"
     # Write the response to a JSON file
     with open(file_path, 'w+') as file:
@@ -79,13 +158,54 @@ def main(records, file_dir="/tmp"):
 
     message = "Output generated and files uploaded to S3 bucket"
 
-    return message
+    return message, failed_message_ids
 
-def upload_to_s3(client, file_path, object_name):
+def enrich_record(id, record, google_api_key):
+    """
+    Get the Google Maps details of a Geoapify record, an error only affects this record
+    Expected output:
+    - the details to add to the record, empty if the place could not be found on Google Maps
+    - None if the requests failed in a way that may succeed on a retry
+    """
+    try:
+        term = record["name"]
+        lon, lat = record["lon"], record["lat"]
+        cache_keys = [f"id:{id}", f"query:{term}|{lon}|{lat}"]
+        google_response = google_place_details(term, lon, lat, google_api_key, cache_keys)
+        return poi_schema_formatter(google_response["result"], poi_data_schema)
+    except requests.RequestException as e:
+        if not is_retryable_error(e):
+            print(f"Record {id} failed and is not retried: {e}")
+            return {}
+        print(f"Record {id} failed: {e}")
+        return None
+    except Exception as e:
+        print(e)
+        return {}
 
+def generate_file_name(ids):
+    """
+    Generate a stable name for the output of a batch, the same for every delivery of the same records
+    """
+    return hashlib.sha256(",".join(sorted(ids)).encode("utf-8")).hexdigest()
+
+def get_object_key(object_name):
     # Get current date to store data under this key
     current_date = datetime.today().strftime('%Y-%m-%d')
-    final_key = f"poi-api/{current_date}/google-maps/{object_name}"
+    return f"poi-api/{current_date}/google-maps/{object_name}"
+
+def object_exists(client, object_key):
+    try:
+        client.head_object(Bucket="stonehenge-fyp", Key=object_key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+
+def upload_to_s3(client, file_path, object_name):
+
+    final_key = get_object_key(object_name)
 
     with open(file_path, "rb") as f:
         client.upload_fileobj(f, "stonehenge-fyp", final_key)
@@ -127,30 +247,229 @@ def format_unicode_to_str(string):
             output += char
     return output
 
-def google_place_details(term, long, lat, google_api_key):
+def google_place_details(term, long, lat, google_api_key, cache_keys=None):
     """
     Function to make API request to Google Places (Place Search + Place Details)
+    The Place Search is skipped when the place id is found in the place id cache under one of cache_keys
     """
-    # format placesearch url, use uri encoding
+    found, place_id = lookup_place_id(cache_keys or [])
+    if found and place_id is None:
+        raise Exception(f"No Google Maps results for {term} (cached)")
+
+    if not found:
+        # format placesearch url, use uri encoding
+        query = {
+            "query": term,
+            "location": f"{lat},{long}",
+            "key": google_api_key
+        }
+        google_response = http_client.get_json("https://maps.googleapis.com/maps/api/place/textsearch/json", query)
+        check_google_status(google_response)
+
+        # Only cache a search that succeeded without results, errors may not happen again
+        if google_response.get("status") == "ZERO_RESULTS":
+            store_place_id(cache_keys or [], None)
+            raise Exception(f"No Google Maps results for {term}")
 
+        # get place_id from placesearch response
+        place_id = google_response["results"][0]["place_id"]
+        store_place_id(cache_keys or [], place_id)
+    
+    # format placedetails url, use uri encoding
     query = {
-        "query": term,
-        "location": f"{lat},{long}",
+        "place_id": place_id,
+        "fields": "name,rating,formatted_phone_number,opening_hours,website,business_status,user_ratings_total,vicinity",
         "key": google_api_key
     }
+    google_response = http_client.get_json("https://maps.googleapis.com/maps/api/place/details/json", query)
+    check_google_status(google_response)
 
-    query_term = encode(query)
-    url = f"https://maps.googleapis.com/maps/api/place/textsearch/json?{query_term}"
-    headers = CaseInsensitiveDict()
-    headers["Accept"] = "application/json"
-    google_response = requests.get(url, headers=headers)
-    
-    # get place_id from placesearch response
-    place_id = google_response.json()["results"][0]["place_id"]
-    
-    # format placedetails url, use uri encoding
-    url = f"https://maps.googleapis.com/maps/api/place/details/json?place_id={place_id}&fields=name,rating,formatted_phone_number,opening_hours,website,business_status,user_ratings_total,vicinity&key={google_api_key}"
-    headers = CaseInsensitiveDict()
-    headers["Accept"] = "application/json"
-    final_response = requests.get(url, headers=headers)
-    return final_response.json()
\ No newline at end of file
+    return google_response
+
+def is_retryable_error(error):
+    """
+    Check whether a failed request may succeed when the message is received again
+    Client errors other than 429 fail the same way on every delivery, rate limits, server errors and timeouts may not
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return True
+    return not (400 <= response.status_code < 500 and response.status_code != 429)
+
+def check_google_status(google_response):
+    """
+    Raise an error for a Google Maps API response that may succeed when the request is made again later
+    """
+    status = google_response.get("status")
+    if status in GOOGLE_RETRY_STATUSES:
+        raise requests.HTTPError(f"Google Maps API returned {status}")
+
+def lookup_place_id(cache_keys):
+    """
+    Look up the Google place id of a record in the place id cache
+    Expected input:
+    - cache_keys: the keys of the record, tried in order
+    Expected output:
+    - whether an unexpired resolution was found
+    - the Google place id, or None if the text search had no results
+    """
+    now = time.time()
+    with place_id_cache_lock:
+        for cache_key in cache_keys:
+            entry = place_id_cache["entries"].get(cache_key)
+            if entry is not None and entry["expires_at"] > now:
+                place_id_cache_stats["hits" if entry["place_id"] is not None else "no_results_hits"] += 1
+                return True, entry["place_id"]
+
+        if cache_keys:
+            place_id_cache_stats["misses"] += 1
+    return False, None
+
+def store_place_id(cache_keys, place_id):
+    """
+    Store the Google place id of a record under every key of the record
+    Expected input:
+    - cache_keys: the keys of the record
+    - place_id: the Google place id, or None if the text search had no results
+    """
+    ttl = PLACE_ID_TTL_SECONDS if place_id is not None else NO_RESULTS_TTL_SECONDS
+    entry = {"place_id": place_id, "expires_at": time.time() + ttl}
+    with place_id_cache_lock:
+        for cache_key in cache_keys:
+            place_id_cache["entries"][cache_key] = entry
+            place_id_cache["pending"][cache_key] = entry
+
+def load_place_id_cache(client):
+    """
+    Load the place id cache, reading only the objects saved since the warm container last read it
+    Expected input:
+    - client: the S3 client
+    """
+    if PLACE_ID_CACHE_PATH is not None:
+        if os.path.exists(PLACE_ID_CACHE_PATH):
+            with open(PLACE_ID_CACHE_PATH) as file:
+                merge_place_id_entries(json.load(file))
+        return
+
+    shard_keys = list_place_id_cache_objects(client)
+    for keys in shard_keys.values():
+        for key in keys:
+            if key in place_id_cache["loaded_keys"]:
+                continue
+            entries = read_place_id_cache_object(client, key)
+            if entries is not None:
+                merge_place_id_entries(entries)
+            place_id_cache["loaded_keys"].add(key)
+
+    # Forget the objects removed by a compaction, their entries are in the compacted object
+    place_id_cache["loaded_keys"] &= {key for keys in shard_keys.values() for key in keys}
+    place_id_cache["shard_keys"] = shard_keys
+
+def save_place_id_cache(client):
+    """
+    Save the resolutions made by this invocation as new objects of their shards, compacting the shards with many objects
+    Expected input:
+    - client: the S3 client
+    """
+    if not place_id_cache["pending"]:
+        return
+
+    if PLACE_ID_CACHE_PATH is not None:
+        # Merge on top of the stored file, and replace it in one step so that an interruption never leaves it half written
+        load_place_id_cache(client)
+        merge_place_id_entries(place_id_cache["pending"])
+        now = time.time()
+        entries = {key: entry for key, entry in place_id_cache["entries"].items() if entry["expires_at"] > now}
+        with open(f"{PLACE_ID_CACHE_PATH}.tmp", "w") as file:
+            json.dump(entries, file)
+        os.replace(f"{PLACE_ID_CACHE_PATH}.tmp", PLACE_ID_CACHE_PATH)
+        place_id_cache["pending"] = {}
+        return
+
+    shard_entries = {}
+    for cache_key, entry in place_id_cache["pending"].items():
+        shard_entries.setdefault(get_place_id_cache_shard(cache_key), {})[cache_key] = entry
+
+    for shard, entries in shard_entries.items():
+        key = write_place_id_cache_object(client, shard, entries)
+        place_id_cache["loaded_keys"].add(key)
+
+        # Objects listed when the cache was loaded, all merged into the entries held by the container
+        merged_keys = [key for key in place_id_cache["shard_keys"].get(shard, []) if key in place_id_cache["loaded_keys"]]
+        if len(merged_keys) >= PLACE_ID_CACHE_COMPACT_OBJECTS:
+            compact_place_id_cache_shard(client, shard, merged_keys + [key])
+    place_id_cache["pending"] = {}
+
+def compact_place_id_cache_shard(client, shard, merged_keys):
+    """
+    Replace the objects of a shard with one object of their unexpired entries
+    Objects saved by other invocations in the meantime are not removed, so no resolution is lost
+    Expected input:
+    - client: the S3 client
+    - shard: the shard to compact
+    - merged_keys: the objects of the shard merged into the entries held by the container
+    """
+    now = time.time()
+    with place_id_cache_lock:
+        entries = {key: entry for key, entry in place_id_cache["entries"].items() if get_place_id_cache_shard(key) == shard and entry["expires_at"] > now}
+    compacted_key = write_place_id_cache_object(client, shard, entries)
+    place_id_cache["loaded_keys"].add(compacted_key)
+
+    for key in merged_keys:
+        client.delete_object(Bucket="stonehenge-fyp", Key=key)
+        place_id_cache["loaded_keys"].discard(key)
+    place_id_cache["shard_keys"][shard] = [compacted_key]
+
+def merge_place_id_entries(entries):
+    """
+    Merge stored resolutions into the cache held by the container, keeping the latest resolution of each key
+    """
+    with place_id_cache_lock:
+        for cache_key, entry in entries.items():
+            held_entry = place_id_cache["entries"].get(cache_key)
+            if held_entry is None or entry["expires_at"] > held_entry["expires_at"]:
+                place_id_cache["entries"][cache_key] = entry
+
+def get_place_id_cache_shard(cache_key):
+    return int(hashlib.sha256(cache_key.encode("utf-8")).hexdigest(), 16) % PLACE_ID_CACHE_SHARDS
+
+def list_place_id_cache_objects(client):
+    """
+    List the objects of the stored place id cache
+    Expected output:
+    - a dictionary of shard to the keys of its objects
+    """
+    shard_keys = {}
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket="stonehenge-fyp", Prefix=PLACE_ID_CACHE_PREFIX):
+        for obj in page.get("Contents", []):
+            shard = int(obj["Key"][len(PLACE_ID_CACHE_PREFIX):].split("/")[0])
+            shard_keys.setdefault(shard, []).append(obj["Key"])
+
+    return shard_keys
+
+def read_place_id_cache_object(client, key):
+    """
+    Read one object of the stored place id cache
+    Expected output:
+    - the cache entries, or None if the object was removed by a compaction since it was listed
+    """
+    try:
+        response = client.get_object(Bucket="stonehenge-fyp", Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return None
+        raise
+
+    return json.loads(response["Body"].read())
+
+def write_place_id_cache_object(client, shard, entries):
+    """
+    Write cache entries as a new object of their shard, named uniquely so that it never replaces another object
+    Expected output:
+    - the key of the new object
+    """
+    key = f"{PLACE_ID_CACHE_PREFIX}{shard}/{int(time.time() * 1000)}-{uuid.uuid4().hex}.json"
+    client.put_object(Bucket="stonehenge-fyp", Key=key, Body=json.dumps(entries).encode("utf-8"))
+
+    return key
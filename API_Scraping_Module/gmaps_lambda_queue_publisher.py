@@ -1,6 +1,27 @@
 import boto3
 import json
+import time
+import uuid
+import codecs
 import urllib.parse
+from sqs_batch import publish_messages
+
+# Records grouped into one message, the GMaps API scraper receives up to 50 messages per invocation
+# and makes 2 Google Maps API calls per record within its 900 seconds timeout
+RECORDS_PER_MESSAGE = 4
+
+# SQS accepts at most 256 KB per message
+SQS_MESSAGE_BYTES = 256 * 1024
+
+# Size of the chunks read from the S3 object body
+READ_CHUNK_BYTES = 64 * 1024
+
+# Place ids published in a run, under poi-api/{date}/. Each invocation adds its own object, merged when the ids are read,
+# so that a POI returned by several segments, tiles or categories is only enriched once
+PUBLISHED_IDS_DIRECTORY = "gmaps-published-ids/"
+
+# Records of the last invocation, and those skipped as already published
+publish_stats = {"records": 0, "duplicates": 0}
 
 def handler(event, context):
     bucket = event["Records"][0]["s3"]["bucket"]["name"]
@@ -14,20 +35,183 @@ def main(bucket, object_key):
     sqs_client = boto3.client("sqs")
     s3_client = boto3.client("s3")
 
-    # Get S3 object data
-    data = get_s3_object(s3_client, bucket, object_key)
-
     # Get SQS Queue URL
     queue_url = sqs_client.get_queue_url(QueueName="POI-GMaps")["QueueUrl"]
 
-    # Publish each Geoapify record to queue in separate messages
-    for key, value in data.items():
-        body = json.dumps({key: value})
+    # Place ids already published by the other outputs of the run
+    published_ids_prefix = get_published_ids_prefix(object_key)
+    published_ids = load_published_ids(s3_client, bucket, published_ids_prefix)
+    new_ids = {}
+
+    # Stream the S3 object data, only the records of the messages being published are held in memory
+    response = s3_client.get_object(Bucket=bucket, Key=object_key)
+    records = skip_published_records(iter_json_object_items(response["Body"]), published_ids, new_ids)
+
+    # Publish the Geoapify records to queue, grouped several to a message
+    publish_stats.update({"records": 0, "duplicates": 0})
+    start = time.perf_counter()
+    published = publish_messages(sqs_client, queue_url, group_records(records))
+    seconds = time.perf_counter() - start
+    print(f"Published {published} messages in {seconds:.2f}s ({published / seconds if seconds else 0.0:.1f} messages/s)")
+    print(f"Published {publish_stats['records']} records, skipped {publish_stats['duplicates']} already published")
+
+    # Only saved once the records are published, a failed invocation publishes them again when retried
+    save_published_ids(s3_client, bucket, published_ids_prefix, new_ids)
+
+    return "Function finished"
+
+def iter_json_object_items(stream, chunk_bytes=READ_CHUNK_BYTES):
+    """
+    Parse a JSON object incrementally from a binary stream
+    Expected input:
+    - stream: a binary stream such as the body of an S3 object, containing one JSON object
+    - chunk_bytes: the number of bytes read from the stream at once
+    Expected output:
+    - a generator of the (key, value) pairs of the object, in order
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    end_of_stream = False
+    # The object is parsed as "{", then a key or "}", ":", a value, then "," or "}" until the closing "}"
+    expected = "{"
+
+    while expected != "done":
+        # Skip the whitespace between tokens
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+
+        # Parse the next token, end is left as None when it may continue in the data not read yet
+        end = None
+        if position < len(buffer):
+            char = buffer[position]
+            if expected == "{" or expected == ":":
+                if char != expected:
+                    raise ValueError(f"Expected '{expected}' at position {position} of the buffer")
+                end = position + 1
+            elif expected == "," or (expected == "key" and char == "}"):
+                if char not in ",}":
+                    raise ValueError(f"Expected ',' or '}}' at position {position} of the buffer")
+                end = position + 1
+            else:
+                try:
+                    token, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    end = None
+                # A number at the end of the buffer may have more digits in the next chunk
+                if end == len(buffer) and not end_of_stream:
+                    end = None
+
+        if end is None:
+            if end_of_stream:
+                raise ValueError("The stream does not contain a complete JSON object")
+            # Keep only the unparsed text and read the next chunk
+            chunk = stream.read(chunk_bytes)
+            end_of_stream = not chunk
+            buffer = buffer[position:] + utf8.decode(chunk, final=end_of_stream)
+            position = 0
+            continue
+
+        if expected == "{":
+            expected = "key"
+        elif expected == "key" and char == "}":
+            expected = "done"
+        elif expected == "key":
+            key = token
+            expected = ":"
+        elif expected == ":":
+            expected = "value"
+        elif expected == "value":
+            expected = ","
+            yield key, token
+        else:
+            expected = "key" if char == "," else "done"
+        position = end
+
+def get_published_ids_prefix(object_key):
+    """
+    Get the prefix of the place ids published in the run of a Geoapify output, poi-api/{date}/gmaps-published-ids/
+    """
+    return "/".join(object_key.split("/")[:2]) + "/" + PUBLISHED_IDS_DIRECTORY
+
+def load_published_ids(client, bucket, prefix):
+    """
+    Load the place ids published in a run
+    Expected input:
+    - client: the S3 client
+    - bucket: the bucket containing the Geoapify outputs
+    - prefix: the prefix of the published ids of the run
+    Expected output:
+    - a dictionary of place id to the regions it was published with, None if it has none
+    """
+    published_ids = {}
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            ids = json.loads(client.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read())
+            for id, regions in ids.items():
+                published_ids[id] = merge_regions(published_ids.get(id), regions)
+
+    return published_ids
+
+def save_published_ids(client, bucket, prefix, ids):
+    """
+    Save the place ids published by the invocation as a new object, named uniquely so that it never replaces another object
+    """
+    if ids:
+        key = f"{prefix}{int(time.time() * 1000)}-{uuid.uuid4().hex}.json"
+        client.put_object(Bucket=bucket, Key=key, Body=json.dumps(ids).encode("utf-8"))
 
-        sqs_client.send_message(QueueUrl=queue_url, MessageBody=body)
+def skip_published_records(records, published_ids, new_ids):
+    """
+    Leave out the records whose place id is already published in the run
+    A record is published again only when it belongs to a region it was not published with, so that the merged output keeps
+    every region of a POI on the edge between two regions
+    Expected input:
+    - records: an iterable of (key, value) pairs of Geoapify records
+    - published_ids: the place ids published in the run, from load_published_ids, updated with the records published
+    - new_ids: the place ids published by the invocation, updated with the records published
+    Expected output:
+    - a generator of the (key, value) pairs to publish
+    """
+    for key, value in records:
+        regions = value.get("regions") if isinstance(value, dict) else None
+        if key in published_ids and set(regions or []) <= set(published_ids[key] or []):
+            publish_stats["duplicates"] += 1
+            continue
+        published_ids[key] = merge_regions(published_ids.get(key), regions)
+        new_ids[key] = published_ids[key]
+        publish_stats["records"] += 1
+        yield key, value
 
-def get_s3_object(client, bucket, object_key):
-    response = client.get_object(Bucket=bucket, Key=object_key)
-    obj_data = response["Body"].read()
+def merge_regions(regions, other_regions):
+    """
+    Merge the regions of two copies of a POI, None if neither has any
+    """
+    if regions is None and other_regions is None:
+        return None
+    return list(dict.fromkeys((regions or []) + (other_regions or [])))
 
-    return json.loads(obj_data)
\ No newline at end of file
+def group_records(records, records_per_message=RECORDS_PER_MESSAGE, max_bytes=SQS_MESSAGE_BYTES):
+    """
+    Group the records into message bodies read by the GMaps API scraper
+    Expected input:
+    - records: an iterable of (key, value) pairs of Geoapify records
+    - records_per_message: the largest number of records in one message
+    - max_bytes: the largest size of one message body
+    Expected output:
+    - a generator of message bodies, each a JSON object of several records
+    """
+    group, group_bytes = [], 2
+    for key, value in records:
+        # Serialise each record as an entry of the object, the same as json.dumps({key: value})
+        entry = json.dumps({key: value})[1:-1]
+        entry_bytes = len(entry.encode("utf-8")) + 2
+        if group and (len(group) == records_per_message or group_bytes + entry_bytes > max_bytes):
+            yield "{" + ", ".join(group) + "}"
+            group, group_bytes = [], 2
+        group.append(entry)
+        group_bytes += entry_bytes
+    if group:
+        yield "{" + ", ".join(group) + "}"
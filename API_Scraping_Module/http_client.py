@@ -0,0 +1,146 @@
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# Responses that are worth retrying, as the same request may succeed later
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20
+
+# Connect and read timeouts in seconds
+DEFAULT_TIMEOUT = (5, 30)
+
+# Connections kept open per host
+POOL_SIZE = 20
+
+# Pooled session and latency stats, kept across invocations of a warm Lambda container
+session = None
+latency_stats = {"requests": 0, "retries": 0, "failures": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+stats_lock = threading.Lock()
+
+# Requests per second allowed across every thread of the container, None for no limit
+# The limit is not shared between containers, a quota shared by concurrent invocations must be divided between them
+rate_limit = {"requests_per_second": None, "next_request": 0.0}
+rate_limit_lock = threading.Lock()
+
+def get_session():
+    """
+    Get the pooled keep-alive session shared by every request of the container
+    Expected output:
+    - a requests.Session accepting JSON responses
+    """
+    global session
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["Accept"] = "application/json"
+
+    return session
+
+def get_json(url, params=None, timeout=DEFAULT_TIMEOUT, max_attempts=MAX_ATTEMPTS):
+    """
+    Make a GET request and parse its JSON response, retrying transient failures with exponential backoff and jitter
+    Expected input:
+    - url: the URL of the request
+    - params: optional query parameters, encoded into the URL
+    - timeout: the connect and read timeouts in seconds
+    - max_attempts: the number of attempts before giving up
+    Expected output:
+    - the parsed JSON response, an exception is raised if the request did not succeed after every attempt
+    """
+    for attempt in range(max_attempts):
+        wait_for_rate_limit()
+        start = time.perf_counter()
+        try:
+            response = get_session().get(url, params=params, timeout=timeout)
+            error = None
+        except (requests.ConnectionError, requests.Timeout) as e:
+            response = None
+            error = e
+        record_latency(time.perf_counter() - start)
+
+        if response is not None and response.status_code not in RETRY_STATUS_CODES:
+            # Other client errors will not succeed on a retry
+            if not response.ok:
+                with stats_lock:
+                    latency_stats["failures"] += 1
+            response.raise_for_status()
+            return response.json()
+
+        if attempt == max_attempts - 1:
+            break
+
+        # Full jitter backoff, unless the API says how long to wait
+        delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            delay = min(BACKOFF_MAX_SECONDS, int(retry_after))
+        print(f"Retrying request in {delay:.2f}s after {error if error is not None else f'HTTP {response.status_code}'}")
+        with stats_lock:
+            latency_stats["retries"] += 1
+        time.sleep(delay)
+
+    with stats_lock:
+        latency_stats["failures"] += 1
+    if error is not None:
+        raise error
+    response.raise_for_status()
+
+def set_rate_limit(requests_per_second):
+    """
+    Limit the requests made by every thread of the container together, retries included
+    Expected input:
+    - requests_per_second: the largest number of requests started per second, None for no limit
+    """
+    with rate_limit_lock:
+        rate_limit["requests_per_second"] = requests_per_second
+
+def wait_for_rate_limit():
+    """
+    Wait until the next request can start within the rate limit
+    """
+    with rate_limit_lock:
+        if not rate_limit["requests_per_second"]:
+            return
+        # Reserve the next free slot, the requests are spaced evenly
+        now = time.monotonic()
+        slot = max(now, rate_limit["next_request"])
+        rate_limit["next_request"] = slot + 1 / rate_limit["requests_per_second"]
+
+    if slot > now:
+        time.sleep(slot - now)
+
+def record_latency(seconds):
+    """
+    Add the latency of one request to the latency stats
+    Expected input:
+    - seconds: the duration of the request
+    """
+    with stats_lock:
+        latency_stats["requests"] += 1
+        latency_stats["total_seconds"] += seconds
+        latency_stats["max_seconds"] = max(latency_stats["max_seconds"], seconds)
+
+def get_latency_stats():
+    """
+    Get the latency stats of the requests made so far
+    Expected output:
+    - a dictionary with the number of requests, retries and failures, and the average and maximum latency in seconds
+    """
+    with stats_lock:
+        stats = dict(latency_stats)
+
+    stats["average_seconds"] = stats["total_seconds"] / stats["requests"] if stats["requests"] else 0.0
+    return stats
+
+def reset_latency_stats():
+    """
+    Reset the latency stats, at the start of an invocation
+    """
+    with stats_lock:
+        latency_stats.update({"requests": 0, "retries": 0, "failures": 0, "total_seconds": 0.0, "max_seconds": 0.0})
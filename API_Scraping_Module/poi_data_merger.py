@@ -1,5 +1,6 @@
 import json
 import boto3
+import numpy as np
 import pandas as pd
 from datetime import datetime
 
@@ -22,6 +23,9 @@ def main(file_dir="/tmp", file_name="full_poi_results"):
         data = get_s3_object(client, "stonehenge-fyp", obj)
 
         for key, value in data.items():
+            # A POI on the edge shared by the tiles of two regions belongs to both
+            if key in result_dict and "regions" in result_dict[key] and "regions" in value:
+                value["regions"] = list(dict.fromkeys(result_dict[key]["regions"] + value["regions"]))
             result_dict[key] = value
 
     # Write the records to a JSON file
@@ -85,15 +89,59 @@ def upload_to_s3(client, file_path, object_name):
 def convert_to_csv_and_upload(client, file_dir, file_name):
     # Read the file as a df
     df = pd.read_json(f"{file_dir}/{file_name}.json", orient="index")
+    place_ids = df.index.astype(str)
 
     # Reset the index and rename columns to be more human-readable
     df.reset_index(inplace=True, drop=True)
     df = df.rename(columns={"lat": "latitude", "lon": "longitude"})
 
+    # Upload the snapshot first, as the CSV upload triggers the blending step that reads it
+    snapshot_path = write_snapshot(df, place_ids, file_dir, file_name)
+    upload_to_s3(client, snapshot_path, f"{file_name}.npz")
+
     file_path = f"{file_dir}/{file_name}.csv"
 
     # Write the df to a csv
     df.to_csv(file_path)
 
     # Upload CSV file to S3
-    upload_to_s3(client, file_path, f"{file_name}.csv")
\ No newline at end of file
+    upload_to_s3(client, file_path, f"{file_name}.csv")
+
+def write_snapshot(df, place_ids, file_dir, file_name):
+    """
+    Write the columns needed for blending as typed arrays into an uncompressed .npz file,
+    so that readers can load only the arrays they need without parsing the CSV
+    """
+    # Many POIs share the same opening hours, so the strings are stored once and referenced by code
+    opening_hours = df["opening_hours"] if "opening_hours" in df else pd.Series(np.nan, index=df.index)
+    opening_hours_codes, opening_hours_values = pd.factorize(opening_hours.where(opening_hours.map(lambda x: isinstance(x, str))))
+
+    # Split "catering.restaurant" into "catering" and "restaurant", and store the categories of every POI as codes into a vocabulary
+    categories = df["categories"] if "categories" in df else pd.Series([[]] * len(df), index=df.index)
+    tokens = categories.map(lambda x: list(dict.fromkeys(token for cat in x for token in cat.split("."))) if isinstance(x, list) else [])
+    category_offsets = np.concatenate([[0], np.cumsum(tokens.map(len).to_numpy())])
+    category_codes, category_vocabulary = pd.factorize(pd.Series([token for ls in tokens for token in ls], dtype=object))
+
+    file_path = f"{file_dir}/{file_name}.npz"
+    np.savez(
+        file_path,
+        place_id=np.array(place_ids, dtype="S"),
+        latitude=get_numeric_column(df, "latitude"),
+        longitude=get_numeric_column(df, "longitude"),
+        rating=get_numeric_column(df, "rating"),
+        user_ratings_total=get_numeric_column(df, "user_ratings_total"),
+        opening_hours_codes=opening_hours_codes.astype("int32"),
+        opening_hours_values=np.array(opening_hours_values, dtype=str),
+        category_offsets=category_offsets.astype("int64"),
+        category_codes=category_codes.astype("int32"),
+        category_vocabulary=np.array(category_vocabulary, dtype=str),
+    )
+
+    return file_path
+
+def get_numeric_column(df, column):
+    # Columns that no POI has a value for are missing from the merged JSON
+    if column not in df:
+        return np.full(len(df), np.nan)
+
+    return pd.to_numeric(df[column], errors="coerce").to_numpy(dtype="float64")
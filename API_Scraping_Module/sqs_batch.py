@@ -0,0 +1,86 @@
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# SQS accepts at most 10 entries and 256 KB of message bodies per send_message_batch call
+SQS_BATCH_ENTRIES = 10
+SQS_BATCH_BYTES = 256 * 1024
+PUBLISH_WORKERS = 8
+PUBLISH_MAX_ATTEMPTS = 5
+
+def publish_messages(client, queue_url, bodies, workers=PUBLISH_WORKERS):
+    """
+    Publish the message bodies with send_message_batch calls spread over a thread pool
+    Expected input:
+    - client: the SQS client
+    - queue_url: the URL of the queue
+    - bodies: an iterable of message bodies, consumed as the batches are sent
+    - workers: the number of send_message_batch calls in flight at once
+    Expected output:
+    - the number of messages published
+    """
+    published = 0
+    in_flight = set()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in group_batches(bodies):
+            # Bound the batches waiting to be sent, so that the bodies are not read ahead of the publishing
+            if len(in_flight) >= workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                published += sum(future.result() for future in done)
+            in_flight.add(executor.submit(send_batch, client, queue_url, batch))
+
+        published += sum(future.result() for future in in_flight)
+
+    return published
+
+def group_batches(bodies):
+    """
+    Group the message bodies into batches within both SQS batch limits
+    Expected input:
+    - bodies: an iterable of message bodies
+    Expected output:
+    - a generator of lists of message bodies
+    """
+    batch, batch_bytes = [], 0
+    for body in bodies:
+        body_bytes = len(body.encode("utf-8"))
+        if batch and (len(batch) == SQS_BATCH_ENTRIES or batch_bytes + body_bytes > SQS_BATCH_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(body)
+        batch_bytes += body_bytes
+    if batch:
+        yield batch
+
+def send_batch(client, queue_url, bodies, max_attempts=PUBLISH_MAX_ATTEMPTS):
+    """
+    Send one batch of messages, retrying only the entries that failed
+    Expected input:
+    - client: the SQS client
+    - queue_url: the URL of the queue
+    - bodies: at most 10 message bodies
+    - max_attempts: the number of attempts before giving up on the failed entries
+    Expected output:
+    - the number of messages sent, an exception is raised if some could not be sent
+    """
+    pending = {str(i): body for i, body in enumerate(bodies)}
+
+    for attempt in range(max_attempts):
+        if attempt > 0:
+            # Exponential backoff with jitter before retrying the failed entries
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+
+        entries = [{"Id": entry_id, "MessageBody": body} for entry_id, body in pending.items()]
+        response = client.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        failed = response.get("Failed", [])
+        pending = {entry["Id"]: pending[entry["Id"]] for entry in failed}
+
+        # Failures caused by the message itself will not succeed on a retry
+        if not pending or any(entry["SenderFault"] for entry in failed):
+            break
+
+    if pending:
+        raise RuntimeError(f"Failed to publish {len(pending)} messages: {failed}")
+
+    return len(bodies)
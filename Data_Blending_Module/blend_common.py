@@ -0,0 +1,208 @@
+import math
+import numpy as np
+import pandas as pd
+from blend_distance import EARTH_RADIUS_KM, getDistancesFromLatLonInKm
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+OPENING_INTERVAL_PATTERN = r"(?P<start_hour>\d{1,2})(?::(?P<start_minute>\d{2}))?\s*(?P<start_meridiem>AM|PM)?\s*-\s*(?P<end_hour>\d{1,2})(?::(?P<end_minute>\d{2}))?\s*(?P<end_meridiem>AM|PM)?"
+
+def getLandmarksWithinDistance(df, target_distance, lat, lon, spatial_index=None):
+    """ 
+    Get the landmarks within the target distance from the given dataframe
+    Expected input: 
+    - a dataframe with columns 'latitude' and 'longitude'
+    - target_distance: the target distance in km
+    - lat: latitude of the current location
+    - lon: longitude of the current location
+    - spatial_index: optional index generated by build_spatial_index, used to skip POIs that are far away
+    Expected output: 
+    - a dataframe with columns 'latitude' and 'longitude' and 'distance'
+    """
+    
+    if spatial_index is not None:
+        # Only compute distances for the POIs in the grid cells around the current location
+        positions, distances = getLandmarkPositionsWithinDistance(spatial_index, target_distance, lat, lon)
+        df = df.iloc[positions].copy()
+        df['distance'] = distances
+        return df
+
+    # Get the landmarks within the target distance
+    df['distance'] = getDistancesFromLatLonInKm(lat, lon, np.radians(df['latitude'].to_numpy(dtype=float)), np.radians(df['longitude'].to_numpy(dtype=float)))
+    df = df[df['distance'] <= target_distance]
+    return df
+
+def getLandmarkPositionsWithinDistance(spatial_index, target_distance, lat, lon):
+    """ 
+    Get the row positions of the landmarks within the target distance, using the spatial index
+    Expected input: 
+    - spatial_index: the index generated by build_spatial_index
+    - target_distance: the target distance in km
+    - lat: latitude of the current location
+    - lon: longitude of the current location
+    Expected output: 
+    - an array of row positions of the landmarks within the target distance
+    - an array of the distances of these landmarks in km
+    """
+    
+    positions = get_candidate_indices(spatial_index, target_distance, lat, lon)
+    distances = getDistancesFromLatLonInKm(lat, lon, spatial_index["lat_rad"][positions], spatial_index["lon_rad"][positions])
+    within = distances <= target_distance
+    return positions[within], distances[within]
+
+def build_spatial_index(df, cell_size_km=1):
+    """
+    Build a grid bucket index over the POI coordinates, so that radius queries only scan the POIs nearby
+    Expected input:
+    - df: a dataframe with columns 'latitude' and 'longitude'
+    - cell_size_km: the height of each grid cell in km
+    Expected output:
+    - a dictionary containing the cell size in degrees, the row positions of the POIs in each grid cell
+      and the POI coordinates in radians for getDistancesFromLatLonInKm
+    """
+    cell_deg = math.degrees(cell_size_km / EARTH_RADIUS_KM)
+    lat = df['latitude'].to_numpy(dtype=float)
+    lon = df['longitude'].to_numpy(dtype=float)
+
+    # POIs without coordinates can never be within range, so they are left out of the index
+    positions = np.flatnonzero(~(np.isnan(lat) | np.isnan(lon)))
+    rows = np.floor(lat[positions] / cell_deg).astype(np.int64)
+    cols = np.floor(lon[positions] / cell_deg).astype(np.int64)
+
+    # Group the row positions by grid cell
+    order = np.lexsort((cols, rows))
+    positions, rows, cols = positions[order], rows[order], cols[order]
+    boundaries = np.flatnonzero((np.diff(rows) != 0) | (np.diff(cols) != 0)) + 1
+
+    cells = {}
+    if len(positions) > 0:
+        for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(positions)]):
+            cells[(int(rows[start]), int(cols[start]))] = positions[start:end]
+
+    return {"cell_deg": cell_deg, "cells": cells, "lat_rad": np.radians(lat), "lon_rad": np.radians(lon)}
+
+def get_candidate_indices(spatial_index, target_distance, lat, lon):
+    """
+    Get the row positions of the POIs in the grid cells that overlap the search radius
+    Expected input:
+    - spatial_index: the index generated by build_spatial_index
+    - target_distance: the target distance in km
+    - lat: latitude of the current location
+    - lon: longitude of the current location
+    Expected output:
+    - a sorted array of row positions, a superset of the POIs within the target distance
+    """
+    # A listing without valid coordinates is within no distance of any POI, as in a full scan of the NaN distances
+    if not (math.isfinite(lat) and math.isfinite(lon)):
+        return np.empty(0, dtype=np.int64)
+
+    cell_deg = spatial_index["cell_deg"]
+    cells = spatial_index["cells"]
+
+    # Widest latitude and longitude offsets that a point within the target distance can have
+    angular_distance = target_distance / EARTH_RADIUS_KM
+    lat_span = math.degrees(angular_distance)
+    cos_lat = math.cos(math.radians(lat))
+    if math.sin(angular_distance) < cos_lat:
+        lon_span = math.degrees(math.asin(math.sin(angular_distance) / cos_lat))
+    else:
+        lon_span = 180
+
+    row_range = range(math.floor((lat - lat_span) / cell_deg), math.floor((lat + lat_span) / cell_deg) + 1)
+    col_range = range(math.floor((lon - lon_span) / cell_deg), math.floor((lon + lon_span) / cell_deg) + 1)
+
+    if len(row_range) * len(col_range) > len(cells):
+        buckets = [bucket for (row, col), bucket in cells.items() if row in row_range and col in col_range]
+    else:
+        buckets = [cells[(row, col)] for row in row_range for col in col_range if (row, col) in cells]
+
+    if not buckets:
+        return np.empty(0, dtype=np.int64)
+
+    # Keep the original row order so that ties are resolved the same way as a full scan
+    return np.sort(np.concatenate(buckets))
+
+def build_category_matrix(categories, to_aggregate):
+    """
+    Parse the categories of every POI once into a category membership matrix
+    Expected input:
+    - categories: the 'categories' column of the POI dataframe, where each value is a stringified list of categories
+    - to_aggregate: the list of categories to aggregate, its order gives the integer code of each category
+    Expected output:
+    - a boolean matrix of shape (number of POIs, number of categories to aggregate),
+      True where the POI has the category as one of its tokens
+    """
+    vocabulary = {cat: code for code, cat in enumerate(to_aggregate)}
+
+    # Split "['catering', 'catering.restaurant']" into one token per row, indexed by the POI row position
+    tokens = categories.reset_index(drop=True).astype(str) \
+        .str.replace(r"[\[\]' ]", "", regex=True) \
+        .str.replace(".", ",", regex=False) \
+        .str.split(",") \
+        .explode()
+    codes = tokens.map(vocabulary).dropna()
+
+    category_matrix = np.zeros((len(categories), len(to_aggregate)), dtype=bool)
+    category_matrix[codes.index.to_numpy(dtype=np.int64), codes.to_numpy(dtype=np.int64)] = True
+    return category_matrix
+
+def parse_opening_hours(opening_hours, return_intervals=False):
+    """
+    Parse a whole column of opening hours strings into the total operating hours per week
+    Expected input:
+    - opening_hours: a pandas Series of strings such as "Monday: 11:00 AM – 2:00 PM, 5:00 – 10:00 PM,Tuesday: Closed,Wednesday: Open 24 hours,..."
+    - return_intervals: whether to also return the opening intervals of each day
+    Expected output:
+    - a Series of weekly operating hours aligned with opening_hours, NaN where there is no opening hours string
+    - if return_intervals is True, a DataFrame with one row per opening interval and the columns 'day', 'start' and 'end'
+      in hours since midnight (an overnight interval ends after 24), indexed by the row position in opening_hours
+    """
+    # Many POIs share the same opening hours, so only the distinct strings are parsed
+    codes, uniques = pd.factorize(opening_hours.where(opening_hours.map(lambda x: isinstance(x, str) and x != "")))
+    text = pd.Series(uniques, dtype=object)
+    
+    # Normalise the thin spaces and dashes that Google uses between the times
+    text = text.str.replace(r"[\u2009\u202f\u00a0]", " ", regex=True).str.replace(r"[\u2013\u2014]", "-", regex=True)
+    
+    # Split each string into one row per day, the intervals within a day are also separated by commas
+    days = text.str.split(r",\s*(?=(?:{}):)".format("|".join(WEEKDAYS)), regex=True).explode().dropna()
+    days = days.str.extract(r"^\s*(?:(?P<day>{})\s*:)?\s*(?P<hours>.*)$".format("|".join(WEEKDAYS)))
+    days = days.reset_index(names="unique")
+    
+    intervals = days['hours'].str.extractall(OPENING_INTERVAL_PATTERN).droplevel("match")
+    start_hour = intervals['start_hour'].astype(float).to_numpy()
+    end_hour = intervals['end_hour'].astype(float).to_numpy()
+    # "5:00 - 10:00 PM" leaves out the meridiem of the start time when it is the same as the end time
+    start_meridiem = intervals['start_meridiem'].fillna(intervals['end_meridiem']).to_numpy()
+    end_meridiem = intervals['end_meridiem'].to_numpy()
+    start = np.where(pd.isnull(start_meridiem), start_hour, start_hour % 12 + np.where(start_meridiem == "PM", 12, 0))
+    end = np.where(pd.isnull(end_meridiem), end_hour, end_hour % 12 + np.where(end_meridiem == "PM", 12, 0))
+    start += intervals['start_minute'].astype(float).fillna(0).to_numpy() / 60
+    end += intervals['end_minute'].astype(float).fillna(0).to_numpy() / 60
+    # Intervals that end at or before they start run past midnight
+    end = np.where(end <= start, end + 24, end)
+    
+    open_all_day = days[days['hours'].str.contains("Open 24 hours", regex=False)]
+    intervals = pd.concat([
+        pd.DataFrame({"unique": days['unique'].to_numpy()[intervals.index], "day": days['day'].to_numpy()[intervals.index], "start": start, "end": end}),
+        pd.DataFrame({"unique": open_all_day['unique'], "day": open_all_day['day'], "start": 0.0, "end": 24.0}),
+    ])
+    
+    # Days that are closed or cannot be parsed count as 0 hours
+    unique_hours = (intervals['end'] - intervals['start']).groupby(intervals['unique']).sum()
+    unique_hours = unique_hours.reindex(range(len(text)), fill_value=0.0).to_numpy()
+    # Missing opening hours have a code of -1, which picks the NaN appended at the end
+    weekly_hours = pd.Series(np.append(unique_hours, np.nan)[codes], index=opening_hours.index)
+    
+    if return_intervals:
+        positions = pd.DataFrame({"position": np.flatnonzero(codes >= 0), "unique": codes[codes >= 0]})
+        intervals = positions.merge(intervals, on="unique").drop(columns="unique").set_index("position").sort_index(kind="stable")
+        return weekly_hours, intervals
+    return weekly_hours
+
+def get_total_operating_hours(string):
+    """
+    Get the total operating hours from a string:
+    Expected input: "Monday: 11:00 AM – 8:00 PM,Tuesday: 11:00 AM – 8:00 PM,Wednesday: 11:00 AM – 8:00 PM,Thursday: 11:00 AM – 8:00 PM,Friday: 11:00 AM – 8:00 PM,Saturday: 11:00 AM – 8:00 PM,Sunday: 11:00 AM – 8:00 PM"
+    Expected output: 63
+    """
+    return parse_opening_hours(pd.Series([string], dtype=object)).iloc[0]
@@ -0,0 +1,47 @@
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371
+# Radii aggregated around each listing by the data blender, also the reach of a POI change in incremental blending
+TARGET_DISTANCE = [1,3,5] # in km
+
+def getDistanceFromLatLonInKm(lat1,lon1,lat2,lon2):
+    """ 
+    Get the distance between 2 coordinates
+    Expected input: 
+    - lat1: latitude of the first coordinate
+    - lon1: longitude of the first coordinate
+    - lat2: latitude of the second coordinate
+    - lon2: longitude of the second coordinate
+    Expected output: 
+    - the distance between the 2 coordinates in km
+    """
+    
+    # Use the vectorised kernel so that both APIs always return the same distance
+    return float(getDistancesFromLatLonInKm(lat1, lon1, math.radians(lat2), math.radians(lon2)))
+
+def getDistancesFromLatLonInKm(lat, lon, poi_lat_rad, poi_lon_rad):
+    """ 
+    Get the distances between one or many locations and every POI, using the haversine formula
+    Expected input: 
+    - lat: latitude of the current location, or an array of latitudes for many locations
+    - lon: longitude of the current location, or an array of longitudes for many locations
+    - poi_lat_rad: array of POI latitudes in radians
+    - poi_lon_rad: array of POI longitudes in radians
+    Expected output: 
+    - an array of distances in km, with shape (number of POIs,) for one location
+      or (number of locations, number of POIs) for many locations
+    """
+    
+    lat_rad = np.radians(np.asarray(lat, dtype=float))
+    lon_rad = np.radians(np.asarray(lon, dtype=float))
+    if lat_rad.ndim > 0:
+        # One row of distances per location
+        lat_rad = lat_rad[:, np.newaxis]
+        lon_rad = lon_rad[:, np.newaxis]
+
+    dLat = poi_lat_rad - lat_rad
+    dLon = poi_lon_rad - lon_rad
+    a = np.sin(dLat/2) * np.sin(dLat/2) + np.cos(lat_rad) * np.cos(poi_lat_rad) * np.sin(dLon/2) * np.sin(dLon/2)
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+    return EARTH_RADIUS_KM * c # Distance in km
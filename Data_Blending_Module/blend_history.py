@@ -0,0 +1,38 @@
+from botocore.exceptions import ClientError
+
+def get_previous_blend_date(client, bucket, current_date):
+    """
+    Get the date of the latest blend before the current date that has a merged output
+    Expected input:
+    - client: the S3 client
+    - bucket: the bucket containing the blended data
+    - current_date: the current date in YYYY-MM-DD format
+    Expected output:
+    - the date of the previous blend in YYYY-MM-DD format, or None if there is none
+    """
+    dates = []
+    token = ""
+
+    # Every blend is stored under its own blended/{date}/ prefix
+    while True:
+        if token == "":
+            response = client.list_objects_v2(Bucket=bucket, Prefix="blended/", Delimiter="/")
+        else:
+            response = client.list_objects_v2(Bucket=bucket, Prefix="blended/", Delimiter="/", ContinuationToken=token)
+
+        for prefix in response.get("CommonPrefixes", []):
+            dates.append(prefix["Prefix"].split("/")[1])
+
+        if response["IsTruncated"]:
+            token = response["NextContinuationToken"]
+        else:
+            break
+
+    for date in sorted((date for date in dates if date < current_date), reverse=True):
+        try:
+            client.head_object(Bucket=bucket, Key=f"blended/{date}/merged_parts.csv")
+            return date
+        except ClientError:
+            continue
+
+    return None
@@ -1,14 +1,17 @@
+import os
 import boto3
 import pandas as pd
 from datetime import datetime
+from blend_history import get_previous_blend_date
 
 def handler(event, context):
 
-    message = main()
+    # "incremental" carries forward the rows of the previous blend that were not re-blended
+    message = main(mode=os.environ.get("BLEND_MODE", "full"))
 
     return {"message": message}
 
-def main(bucket="stonehenge-fyp"):
+def main(bucket="stonehenge-fyp", mode="full"):
 
     # Initialise merged_df
     merged_df = pd.DataFrame()
@@ -30,6 +33,25 @@ def main(bucket="stonehenge-fyp"):
         df = pd.read_csv(f"/tmp/{part_file_name}")
         merged_df = pd.concat([merged_df, df])
 
+    # Download all listing data
+    listing_prefix = "listings/"
+    listing_file_names = []
+    for listing_file_key in list_all_s3_objects(client, listing_prefix):
+        listing_file_name = listing_file_key.split("/")[-1]
+
+        if listing_file_name != "":
+            download_s3_object(client, bucket, listing_file_key)
+            listing_file_names.append(listing_file_name)
+
+    # Carry forward the previous blend, the rows that were re-blended take precedence
+    if mode == "incremental":
+        previous_df = get_previous_merged_parts(client, bucket, current_date)
+        if previous_df is not None and listing_file_names:
+            # Listings deleted since the previous blend are not carried forward
+            listing_coordinates = pd.concat([pd.read_csv(f"/tmp/{listing_file_name}", usecols=["longitude","latitude"]) for listing_file_name in listing_file_names])
+            previous_df = pd.merge(previous_df, listing_coordinates.drop_duplicates(), on=["longitude","latitude"], how="inner")
+            merged_df = pd.concat([merged_df, previous_df])
+
     # Drop duplicates
     merged_df = merged_df.drop_duplicates(subset=["longitude","latitude"])
 
@@ -40,30 +62,41 @@ def main(bucket="stonehenge-fyp"):
     merged_file_key = f"blended/{current_date}/merged_parts.csv"
     upload_to_s3(client, merged_file_path, merged_file_key)
 
-    # Download all listing data
-    listing_prefix = "listings/"
-    listing_file_keys = list_all_s3_objects(client, listing_prefix)
-
     # Load + left join data to original listing files
-    for listing_file_key in listing_file_keys:
-        listing_file_name = listing_file_key.split("/")[-1]
+    for listing_file_name in listing_file_names:
+        listing_df = pd.read_csv(f"/tmp/{listing_file_name}")
+        # Left join combined_df
+        new_df = pd.merge(listing_df,merged_df, on=["longitude","latitude"], how="left")
 
-        if listing_file_name != "":
-            download_s3_object(client, bucket, listing_file_key)
-            listing_df = pd.read_csv(f"/tmp/{listing_file_name}")
-            # Left join combined_df
-            new_df = pd.merge(listing_df,merged_df, on=["longitude","latitude"], how="left")
+        # Write the df to a CSV file
+        output_file_path = f"/tmp/{listing_file_name}_blended.csv"
+        new_df.to_csv(output_file_path)
 
-            # Write the df to a CSV file
-            output_file_path = f"/tmp/{listing_file_name}_blended.csv"
-            new_df.to_csv(output_file_path)
-
-            # Upload CSV file to S3
-            final_key = f"blended/{current_date}/listings/{listing_file_name}_blended.csv"
-            upload_to_s3(client, output_file_path, final_key)
+        # Upload CSV file to S3
+        final_key = f"blended/{current_date}/listings/{listing_file_name}_blended.csv"
+        upload_to_s3(client, output_file_path, final_key)
 
     return "Data merged, saved to separate files and uploaded to S3"
 
+def get_previous_merged_parts(client, bucket, current_date):
+    """
+    Get the merged parts of the latest blend before the current date
+    Expected input:
+    - client: the S3 client
+    - bucket: the bucket containing the blended data
+    - current_date: the current date in YYYY-MM-DD format
+    Expected output:
+    - a dataframe of the previous merged parts, or None if there is no previous blend
+    """
+    previous_date = get_previous_blend_date(client, bucket, current_date)
+    if previous_date is None:
+        return None
+
+    download_s3_object(client, bucket, f"blended/{previous_date}/merged_parts.csv")
+    print(f"Carrying forward the blend of {previous_date}")
+    # The merged parts are written with their index as the first column
+    return pd.read_csv("/tmp/merged_parts.csv", index_col=0)
+
 def download_s3_object(client, bucket, object_key):
     file_name = object_key.split("/")[-1]
     with open(f"/tmp/{file_name}", "wb") as file:
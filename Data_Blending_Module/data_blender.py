@@ -3,124 +3,157 @@ import pandas as pd
 import numpy as np
 import math
 import json
+import time
+import hashlib
+import gzip
+import base64
+from botocore.exceptions import ClientError
 from datetime import datetime
+from blend_distance import TARGET_DISTANCE, getDistancesFromLatLonInKm
+from blend_common import build_spatial_index, get_candidate_indices, build_category_matrix, parse_opening_hours
+
+# Rings, group keys, weights and distances held per listing x category membership when generating records in blocks
+BLOCK_BYTES_PER_PAIR = 40
+
+# Function configurations
+TO_AGGREGATE = [
+    'access',
+    'amenity',
+    'atm',
+    'bakery',
+    'bank',
+    'beauty',
+    'bus',
+    'cafe',
+    'casino',
+    'childcare',
+    'cinema',
+    'cleaning',
+    'clinic_or_praxis',
+    'college',
+    'convenience',
+    'bar',
+    'beach',
+    'brothel',
+    'dentist',
+    'department_store',
+    'dogs',
+    'dog_park',
+    'dry_cleaning',
+    'education',
+    'educational_institution',
+    'entertainment',
+    'financial',
+    'food_and_drink',
+    'food_court',
+    'fuel',
+    'garden',
+    'gynaecology',
+    'hairdresser',
+    'health_and_beauty',
+    'healthcare',
+    'hospital',
+    'kindergarten',
+    'language_school',
+    'laundry',
+    'leisure',
+    'library',
+    'monorail',
+    'music_school',
+    'nightclub',
+    'no_dogs',
+    'park',
+    'pet',
+    'pharmacy',
+    'playground',
+    'police',
+    'pub',
+    'public_bath',
+    'public_transport',
+    'restaurant',
+    'sand',
+    'school',
+    'service',
+    'shopping_mall',
+    'sport',
+    'stationery',
+    'subway',
+    'super_market',
+    'swimming_pool',
+    'toy_and_game',
+    'train',
+    'tram',
+    'transportation',
+    'university',
+    'vegan' ,
+    'veterinary',
+    'wheelchair'
+]
+
+ADD_COLUMNS = ["total_count","average_rating","average_opening_hours"]
+
+# POI table and its derived structures, kept across invocations of a warm Lambda container
+poi_cache = {"object_key": None, "etag": None, "to_aggregate": None, "poi_data": None}
+poi_cache_stats = {"hits": 0, "misses": 0}
 
 # Lambda Handling Function
 def handler(event, context):
     messages = event["Records"]
     batch_record_ls = []
+    message_ids = []
+    failed_message_ids = []
 
     for message in messages:
-        body = json.loads(message["body"])
-        batch_record_ls.append(body)
+        # A message that cannot be read is returned to the queue on its own
+        try:
+            listings = unpack_listings(json.loads(message["body"]))
+        except Exception as e:
+            print(f"Message {message['messageId']} could not be read: {e}")
+            failed_message_ids.append(message["messageId"])
+            continue
+        batch_record_ls.extend(listings)
+        message_ids.extend([message["messageId"]] * len(listings))
 
-    message = main(batch_record_ls)
+    message, failed = main(batch_record_ls, message_ids=message_ids)
+    failed_message_ids.extend(failed)
 
-    return {"message": message}
+    # Only the failed messages are returned to the queue, the rest of the batch is deleted
+    batch_item_failures = [{"itemIdentifier": message_id} for message_id in failed_message_ids]
 
-def main(record_ls):
-    # Initialise output
-    output = []
+    return {"message": message, "poi_cache_stats": dict(poi_cache_stats), "batchItemFailures": batch_item_failures}
 
+def main(record_ls, message_ids=None):
     # Initialise S3 client
     client = boto3.client("s3")
 
-    # Load POI DF
-    download_s3_object(client, "stonehenge-fyp", "full_poi_results.csv")
-    poi_df = pd.read_csv("/tmp/full_poi_results.csv")
-
-    # Function configurations
-    target_distance = [1,3,5] # in km
-    to_aggregate = [
-        'access',
-        'amenity',
-        'atm',
-        'bakery',
-        'bank',
-        'beauty',
-        'bus',
-        'cafe',
-        'casino',
-        'childcare',
-        'cinema',
-        'cleaning',
-        'clinic_or_praxis',
-        'college',
-        'convenience',
-        'bar',
-        'beach',
-        'brothel',
-        'dentist',
-        'department_store',
-        'dogs',
-        'dog_park',
-        'dry_cleaning',
-        'education',
-        'educational_institution',
-        'entertainment',
-        'financial',
-        'food_and_drink',
-        'food_court',
-        'fuel',
-        'garden',
-        'gynaecology',
-        'hairdresser',
-        'health_and_beauty',
-        'healthcare',
-        'hospital',
-        'kindergarten',
-        'language_school',
-        'laundry',
-        'leisure',
-        'library',
-        'monorail',
-        'music_school',
-        'nightclub',
-        'no_dogs',
-        'park',
-        'pet',
-        'pharmacy',
-        'playground',
-        'police',
-        'pub',
-        'public_bath',
-        'public_transport',
-        'restaurant',
-        'sand',
-        'school',
-        'service',
-        'shopping_mall',
-        'sport',
-        'stationery',
-        'subway',
-        'super_market',
-        'swimming_pool',
-        'toy_and_game',
-        'train',
-        'tram',
-        'transportation',
-        'university',
-        'vegan' ,
-        'veterinary',
-        'wheelchair'
-    ]
-    
-    add_columns = ["total_count","average_rating","average_opening_hours"]
-    
-    # Iterate through the records
-    for record in record_ls:
-        lon = record['longitude']
-        lat = record['latitude']
+    if not record_ls:
+        return "No listings to blend", []
+
+    # Name the output after the listings, so that a redelivered batch is recognised and skipped
+    file_name = generate_file_name(record_ls)
+    if object_exists(client, get_part_key(f"{file_name}.csv")):
+        print(f"Batch {file_name} already processed, skipping")
+        return "Batch already processed", []
 
-        # Generate the record
-        record = generate_record(lon, lat, poi_df, to_aggregate,add_columns, target_distance)
-        output.append(record)
+    # Load POI DF, reusing the copy parsed by a previous invocation if the ETag of the S3 object has not changed
+    poi_data = load_poi_data(client, "stonehenge-fyp", "full_poi_results.csv", TO_AGGREGATE)
+    print(f"POI cache hits: {poi_cache_stats['hits']}, misses: {poi_cache_stats['misses']}")
+
+    # Generate the records for the whole batch together
+    if message_ids is None:
+        message_ids = [None] * len(record_ls)
+    output, failed_message_ids = generate_message_records(record_ls, message_ids, poi_data)
+
+    if failed_message_ids:
+        # Name the output after the listings actually blended, the failed ones come back in another batch
+        record_ls = [record for record, message_id in zip(record_ls, message_ids) if message_id not in failed_message_ids]
+        if not record_ls:
+            return "No listings blended", failed_message_ids
+        file_name = generate_file_name(record_ls)
 
     # Convert to dataframe and output to CSV
     output_df = pd.DataFrame(output)
     
-    # Generate hashed name
-    file_name = generate_file_name(record_ls)
     file_path = f"/tmp/{file_name}.csv"
 
     # Output to CSV
@@ -131,115 +164,161 @@ def main(record_ls):
 
     message = "Output generated and files uploaded to S3 bucket"
 
-    return message
+    return message, failed_message_ids
 
 # Helper Functions
-def getLandmarksWithinDistance(df, target_distance, lat, lon):
-    """ 
-    Get the landmarks within the target distance from the given dataframe
-    Expected input: 
-    - a dataframe with columns 'latitude' and 'longitude'
-    - target_distance: the target distance in km
-    - lat: latitude of the current location
-    - lon: longitude of the current location
-    Expected output: 
-    - a dataframe with columns 'latitude' and 'longitude' and 'distance'
+def unpack_listings(body):
     """
-    
-    # Get the landmarks within the target distance
-    df['distance'] = df.apply(lambda x: getDistanceFromLatLonInKm(lat, lon, x['latitude'], x['longitude']), axis=1)
-    df = df[df['distance'] <= target_distance]
-    return df
-  
-def get_category_ls(str_arr,cur_set=set()):
+    Get the listing records of a message published by the data blender queue publisher
+    Expected input:
+    - body: the parsed message body, either one listing record or several packed by the publisher
+    Expected output:
+    - the list of listing records in the message
+    """
+    if "compressed_listings" in body:
+        return json.loads(gzip.decompress(base64.b64decode(body["compressed_listings"])))
+    if "listings" in body:
+        return body["listings"]
+
+    # Messages published before listings were packed hold a single listing record
+    return [body]
+
+def generate_message_records(record_ls, message_ids, poi_data):
     """
-    Get the list of categories from the string
+    Generate the records of a batch, blending each message on its own if the batch as a whole fails
     Expected input:
-    - str_arr: the string of categories
+    - record_ls: the list of listing records of the batch
+    - message_ids: the id of the SQS message of each listing record
+    - poi_data: the POI data loaded by load_poi_data
     Expected output:
-    - a list of categories
+    - the list of generated records of the messages that succeeded, in the same order as record_ls
+    - the list of ids of the messages that failed
     """
-    for i in str_arr.replace("[", "").replace("]", "").replace("'", "").replace(".", ",").replace(" ", "").split(","):
-        cur_set.add(i)
-    return cur_set
-
-def getDistanceFromLatLonInKm(lat1,lon1,lat2,lon2):
-    """ 
-    Get the distance between 2 coordinates
-    Expected input: 
-    - lat1: latitude of the first coordinate
-    - lon1: longitude of the first coordinate
-    - lat2: latitude of the second coordinate
-    - lon2: longitude of the second coordinate
-    Expected output: 
-    - the distance between the 2 coordinates in km
+    args = (poi_data["poi_df"], TO_AGGREGATE, ADD_COLUMNS, TARGET_DISTANCE, poi_data["spatial_index"], poi_data["category_matrix"])
+    try:
+        return generate_records(record_ls, *args), []
+    except Exception as e:
+        print(f"Blending the batch failed, blending each message separately: {e}")
+
+    output = []
+    failed_message_ids = []
+    # dict.fromkeys keeps the messages in the order of the batch
+    for message_id in dict.fromkeys(message_ids):
+        records = [record for record, record_message_id in zip(record_ls, message_ids) if record_message_id == message_id]
+        try:
+            output.extend(generate_records(records, *args))
+        except Exception as e:
+            print(f"Message {message_id} could not be blended: {e}")
+            failed_message_ids.append(message_id)
+
+    return output, failed_message_ids
+
+def load_poi_data(client, bucket, file_name, to_aggregate):
     """
-    
-    deg2rad = lambda x: x * (math.pi/180)
-    R = 6371 # Radius of the earth in km
-    dLat = deg2rad(lat2-lat1)  # deg2rad below
-    dLon = deg2rad(lon2-lon1) 
-    a = math.sin(dLat/2) * math.sin(dLat/2) + math.cos(deg2rad(lat1)) * math.cos(deg2rad(lat2)) * math.sin(dLon/2) * math.sin(dLon/2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    d = R * c # Distance in km
-    return d
-  
-def categorical_aggregation(category,df):
+    Load the POI table and build its derived structures, revalidating the cached copy with the S3 object's ETag
+    The .npz snapshot published next to the CSV by the POI data merger is preferred over the CSV when it exists
+    Expected input:
+    - client: the S3 client
+    - bucket: the bucket containing the POI table
+    - file_name: the name of the POI table CSV file for the current date
+    - to_aggregate: the list of categories to aggregate
+    Expected output:
+    - a dictionary containing the POI dataframe, its spatial index and its category matrix
+    """
+    current_date = datetime.today().strftime('%Y-%m-%d')
+    snapshot_name = file_name.rsplit(".", 1)[0] + ".npz"
+
+    # A HEAD request is enough to know whether the cached table is still current
+    try:
+        object_name = snapshot_name
+        etag = client.head_object(Bucket=bucket, Key=f"poi-api/{current_date}/{object_name}")["ETag"]
+    except ClientError:
+        object_name = file_name
+        etag = client.head_object(Bucket=bucket, Key=f"poi-api/{current_date}/{object_name}")["ETag"]
+
+    object_key = f"poi-api/{current_date}/{object_name}"
+    if poi_cache["poi_data"] is not None and poi_cache["object_key"] == object_key and poi_cache["etag"] == etag and poi_cache["to_aggregate"] == to_aggregate:
+        poi_cache_stats["hits"] += 1
+        return poi_cache["poi_data"]
+
+    poi_cache_stats["misses"] += 1
+    download_s3_object(client, bucket, object_name)
+    if object_name == snapshot_name:
+        poi_df, category_matrix = load_poi_snapshot(f"/tmp/{object_name}", to_aggregate)
+    else:
+        poi_df, category_matrix = pd.read_csv(f"/tmp/{object_name}"), None
+    poi_data = prepare_poi_data(poi_df, to_aggregate, category_matrix)
+
+    poi_cache.update({"object_key": object_key, "etag": etag, "to_aggregate": list(to_aggregate), "poi_data": poi_data})
+    return poi_data
+
+def load_poi_snapshot(file_path, to_aggregate):
     """
-    Get the category string, filter out the points from the df and aggregate summary statistics.
+    Load the POI snapshot written by the POI data merger, reading only the arrays needed for blending
     Expected input:
-    - category: string
-    - df: A pandas DataFrame containing values that meets the search radius criteria
+    - file_path: the path of the .npz snapshot
+    - to_aggregate: the list of categories to aggregate
     Expected output:
-    - count: integer
-    - average: rating
+    - a dataframe with the columns 'latitude', 'longitude', 'rating' and 'opening_hours'
+    - the category matrix of the POIs, as generated by build_category_matrix
     """
-    
-    filtered_df = df[df.categories.apply(lambda x: category in x)]
-    return filtered_df
+    # Arrays in an .npz file are only read when they are accessed
+    with np.load(file_path) as snapshot:
+        # Opening hours are stored once per distinct string, with -1 for POIs without opening hours
+        opening_hours = np.append(snapshot["opening_hours_values"].astype(object), np.nan)[snapshot["opening_hours_codes"]]
+        poi_df = pd.DataFrame({
+            "latitude": snapshot["latitude"],
+            "longitude": snapshot["longitude"],
+            "rating": snapshot["rating"],
+            "opening_hours": opening_hours,
+        })
+        category_matrix = build_category_matrix_from_codes(snapshot["category_offsets"], snapshot["category_codes"], snapshot["category_vocabulary"], to_aggregate)
 
-def convert_to_24hr(string):
+    return poi_df, category_matrix
+
+def prepare_poi_data(poi_df, to_aggregate, category_matrix=None):
     """
-    Convert a string in the format of "11:00 AM" to hours elapsed since midnight:
-    Expected input: "11:00 AM"
-    Expected output: 11
+    Build the structures that are shared by every record blended against the POI table
+    Expected input:
+    - poi_df: the dataframe containing the POI details
+    - to_aggregate: the list of categories to aggregate
+    - category_matrix: optional category matrix already loaded with the POI table
+    Expected output:
+    - a dictionary containing the POI dataframe (with a 'weekly_opening_hours' column), its spatial index and its category matrix
     """
-    time = 0
-    if string.split(":")[0] == "12":
-        string = "0"+string[2:]
-    if "PM" in string:
-        time += int(string.split(":")[0]) + 12
-    else:
-        time += int(string.split(":")[0])
-    
-    return time+int(string.split(":")[1].split(" ")[0])/60
-    
-def get_total_operating_hours(string):
+    # Parse the opening hours and categories of every POI once
+    poi_df['weekly_opening_hours'] = parse_opening_hours(poi_df['opening_hours'])
+    if category_matrix is None:
+        category_matrix = build_category_matrix(poi_df['categories'], to_aggregate)
+
+    # Build the spatial index once for all the records
+    spatial_index = build_spatial_index(poi_df)
+
+    return {"poi_df": poi_df, "spatial_index": spatial_index, "category_matrix": category_matrix}
+
+def build_category_matrix_from_codes(offsets, codes, vocabulary, to_aggregate):
     """
-    Get the total operating hours from a string:
-    Expected input: "Monday: 11:00 AM – 8:00 PM,Tuesday: 11:00 AM – 8:00 PM,Wednesday: 11:00 AM – 8:00 PM,Thursday: 11:00 AM – 8:00 PM,Friday: 11:00 AM – 8:00 PM,Saturday: 11:00 AM – 8:00 PM,Sunday: 11:00 AM – 8:00 PM"
-    Expected output: 63
+    Build the category membership matrix from categories that are already tokenised into codes
+    Expected input:
+    - offsets: array where the categories of POI i are codes[offsets[i]:offsets[i+1]]
+    - codes: array of codes into vocabulary
+    - vocabulary: array of category tokens
+    - to_aggregate: the list of categories to aggregate
+    Expected output:
+    - a boolean matrix of shape (number of POIs, number of categories to aggregate), as generated by build_category_matrix
     """
-    # Initialize the total hours
-    if string == np.nan or string == None or string == "" or not isinstance(string, str):
-        return np.nan
-        
-    total_hours = 0
-    string=string.replace(" ", " ").replace("–", "-").replace("\u202f"," ")
-    
-    # Split the string by comma
-    weekdays = string.split(",")
-    for day_str in weekdays:
-        try:
-            time_str = day_str.split(":",maxsplit=1)[1].strip()
-            start_time = time_str.split("-")[0].strip()
-            end_time = time_str.split("-")[1].strip()
-            total_hours += convert_to_24hr(end_time) - convert_to_24hr(start_time)
-        except:
-            continue
-    return total_hours
+    aggregate_codes = {cat: code for code, cat in enumerate(to_aggregate)}
+
+    # Translate the vocabulary codes into codes of to_aggregate, with -1 for the categories that are not aggregated
+    lookup = np.array([aggregate_codes.get(token, -1) for token in vocabulary], dtype=np.int64)
+    columns = lookup[codes]
+    rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
 
-def generate_record(lon,lat,poi_df,to_aggregate,add_columns,target_distances=[1,3]):
+    category_matrix = np.zeros((len(offsets) - 1, len(to_aggregate)), dtype=bool)
+    category_matrix[rows[columns >= 0], columns[columns >= 0]] = True
+    return category_matrix
+
+def generate_record(lon,lat,poi_df,to_aggregate,add_columns,target_distances=[1,3],spatial_index=None,category_matrix=None):
   """
   Generate a record for the current listing
   Expected input:
@@ -249,6 +328,106 @@ def generate_record(lon,lat,poi_df,to_aggregate,add_columns,target_distances=[1,
   - to_aggregate: the list of categories to aggregate
   - add_columns: the list of columns to add
   - target_distances: the target distance in km
+  - spatial_index: optional index generated by build_spatial_index from poi_df
+  - category_matrix: optional matrix generated by build_category_matrix from poi_df and to_aggregate
+  Expected output:
+  - a dictionary containing the aggregated values for the current listing
+  """
+  
+  if spatial_index is None:
+    spatial_index = build_spatial_index(poi_df)
+  if category_matrix is None:
+    category_matrix = build_category_matrix(poi_df['categories'], to_aggregate)
+  if 'weekly_opening_hours' not in poi_df:
+    poi_df['weekly_opening_hours'] = parse_opening_hours(poi_df['opening_hours'])
+  
+  return generate_records([{"longitude": lon, "latitude": lat}], poi_df, to_aggregate, add_columns, target_distances, spatial_index, category_matrix)[0]
+
+def generate_records(records, poi_df, to_aggregate, add_columns, target_distances=[1,3], spatial_index=None, category_matrix=None, memory_budget_mb=64):
+  """
+  Generate the records for a batch of listings together, giving the same output as calling generate_record for each listing
+  Expected input:
+  - records: a list of dictionaries containing the 'longitude' and 'latitude' of each listing
+  - poi_df: the dataframe containing the POI details
+  - to_aggregate: the list of categories to aggregate
+  - add_columns: the list of columns to add
+  - target_distances: the target distance in km
+  - spatial_index: optional index generated by build_spatial_index from poi_df
+  - category_matrix: optional matrix generated by build_category_matrix from poi_df and to_aggregate
+  - memory_budget_mb: the largest size of the listings x POIs matrices computed at once, in MB
+  Expected output:
+  - a list of dictionaries containing the aggregated values for each listing, in the same order as records
+  """
+  
+  if spatial_index is None:
+    spatial_index = build_spatial_index(poi_df)
+  if category_matrix is None:
+    category_matrix = build_category_matrix(poi_df['categories'], to_aggregate)
+  if 'weekly_opening_hours' not in poi_df:
+    poi_df['weekly_opening_hours'] = parse_opening_hours(poi_df['opening_hours'])
+  
+  lons = np.array([record['longitude'] for record in records], dtype=float)
+  lats = np.array([record['latitude'] for record in records], dtype=float)
+  radii = sorted(set(target_distances))
+  
+  # Group the listings by grid cell, the listings of a cell share the same candidate landmarks
+  cells = {}
+  for i, (lat, lon) in enumerate(zip(lats, lons)):
+    # The listings without valid coordinates share a cell without candidates, and get a record of NaN values
+    cell = (math.floor(lat / spatial_index["cell_deg"]), math.floor(lon / spatial_index["cell_deg"])) if math.isfinite(lat) and math.isfinite(lon) else None
+    cells.setdefault(cell, []).append(i)
+  
+  output = [None] * len(records)
+  for cell_listings in cells.values():
+    positions = np.unique(np.concatenate([get_candidate_indices(spatial_index, radii[-1], lats[i], lons[i]) for i in cell_listings]))
+    
+    # Every (landmark, category) membership of the candidates, sorted by category, with the values summed per category
+    pair_category, pair_position = np.nonzero(category_matrix[positions].T)
+    ratings = poi_df['rating'].to_numpy(dtype=float)[positions][pair_position]
+    opening_hours = poi_df['weekly_opening_hours'].to_numpy(dtype=float)[positions][pair_position]
+    weights = [None, ~np.isnan(ratings), np.nan_to_num(ratings), ~np.isnan(opening_hours), np.nan_to_num(opening_hours)]
+    present, starts = np.unique(pair_category, return_index=True)
+    
+    # Split the listings of the cell into blocks whose listings x memberships matrices fit in the memory budget
+    block_size = max(1, int(memory_budget_mb * 1024 * 1024 // max(1, len(pair_position) * BLOCK_BYTES_PER_PAIR)))
+    for start in range(0, len(cell_listings), block_size):
+      block = cell_listings[start:start + block_size]
+      distances = getDistancesFromLatLonInKm(lats[block], lons[block], spatial_index["lat_rad"][positions], spatial_index["lon_rad"][positions])
+      totals = np.zeros((len(block), len(radii), 5, len(to_aggregate)))
+      nearest = np.full((len(block), len(to_aggregate)), np.inf)
+      
+      if len(pair_position) > 0:
+        # Group the values by listing, ring and category, ring i holds the landmarks further than radii[i-1] and
+        # within radii[i] and ring len(radii) holds the landmarks outside of every radius
+        ring = np.searchsorted(radii, distances, side='left')[:, pair_position]
+        group = ((np.arange(len(block))[:, np.newaxis] * (len(radii) + 1) + ring) * len(to_aggregate) + pair_category).ravel()
+        for w, weight in enumerate(weights):
+          sums = np.bincount(group, None if weight is None else np.broadcast_to(weight, ring.shape).ravel(), len(block) * (len(radii) + 1) * len(to_aggregate))
+          # Accumulate the rings outwards to get the totals for each radius
+          totals[:, :, w] = np.cumsum(sums.reshape(len(block), len(radii) + 1, len(to_aggregate))[:, :-1], axis=1)
+        
+        # Get the distance to the nearest landmark of each category within the largest radius
+        pair_distances = np.where(ring < len(radii), distances[:, pair_position], np.inf)
+        nearest[:, present] = np.minimum.reduceat(pair_distances, starts, axis=1)
+      
+      for j, i in enumerate(block):
+        output[i] = build_record(records[i]['longitude'], records[i]['latitude'], to_aggregate, add_columns, target_distances, totals[j], nearest[j])
+  
+  return output
+
+def build_record(lon, lat, to_aggregate, add_columns, target_distances, totals, nearest):
+  """
+  Build the record of a listing from its aggregated values
+  Expected input:
+  - lon: longitude of the current location
+  - lat: latitude of the current location
+  - to_aggregate: the list of categories to aggregate
+  - add_columns: the list of columns to add
+  - target_distances: the target distance in km
+  - totals: an array of shape (number of distinct target distances in ascending order, 5, number of categories) holding,
+    over the landmarks of each category within each distance, their count, the count and sum of their known ratings and
+    the count and sum of their known opening hours
+  - nearest: the distance to the nearest landmark of each category within the largest target distance
   Expected output:
   - a dictionary containing the aggregated values for the current listing
   """
@@ -257,47 +436,74 @@ def generate_record(lon,lat,poi_df,to_aggregate,add_columns,target_distances=[1,
   record_dict["latitude"] = lat
   record_dict["longitude"] = lon
   
+  radii = sorted(set(target_distances))
+  count, rating_count, rating_sum, hours_count, hours_sum = totals.transpose(1, 0, 2)
+  
   for dist in target_distances:
-    # Get the landmarks within the target distance
-    result_df = getLandmarksWithinDistance(poi_df, dist, lat, lon)
-    
-    relevant_categories = set()
-    for i in range(len(result_df)):
-        relevant_categories = get_category_ls(result_df.iloc[i]['categories'],relevant_categories)
-    
-    for cat in relevant_categories:
-        if cat in to_aggregate:
-            # Aggregate the summary statistics
-            filtered_df = categorical_aggregation(cat,result_df)
-            # Get the total count
-            record_dict[f"{dist}km_{cat}_total_count"] = len(filtered_df)
-
-            if len(filtered_df) == 0:
-                continue
-            # Get the average rating
-            record_dict[f"{dist}km_{cat}_average_rating"] = filtered_df['rating'].mean()
-            # Get the average open hours, ignore the NaN values
-            record_dict[f"{dist}km_{cat}_average_opening_hours"] = filtered_df['opening_hours'].apply(lambda x: get_total_operating_hours(x)).mean(skipna=True)
-            
-            # # Get the nearest landmark
-            nearest_landmark = filtered_df.query("distance == distance.min()")
-            record_dict[f"distance_to_nearest_{cat}_poi"] = nearest_landmark.distance.values[0]
+    r = radii.index(dist)
+    for k, cat in enumerate(to_aggregate):
+        if count[r, k] == 0:
+            continue
+        # Get the total count
+        record_dict[f"{dist}km_{cat}_total_count"] = int(count[r, k])
+        # Get the average rating
+        record_dict[f"{dist}km_{cat}_average_rating"] = rating_sum[r, k] / rating_count[r, k] if rating_count[r, k] else math.nan
+        # Get the average open hours, ignore the NaN values
+        record_dict[f"{dist}km_{cat}_average_opening_hours"] = hours_sum[r, k] / hours_count[r, k] if hours_count[r, k] else math.nan
+  
+  # Get the distance to the nearest landmark
+  for k, cat in enumerate(to_aggregate):
+    if count[-1, k]:
+        record_dict[f"distance_to_nearest_{cat}_poi"] = nearest[k]
   return record_dict
 
+def benchmark_batch_sizes(records, poi_data, batch_sizes=(1, 10, 50)):
+    """
+    Compare the records per second of the batch engine for different batch sizes, a batch size of 1 being the per-record loop
+    Expected input:
+    - records: a list of dictionaries containing the 'longitude' and 'latitude' of each listing
+    - poi_data: the dictionary generated by prepare_poi_data
+    - batch_sizes: the number of records generated together by the batch engine
+    Expected output:
+    - a dictionary of records per second for each batch size
+    """
+    results = {}
+
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        for i in range(0, len(records), batch_size):
+            generate_records(records[i:i + batch_size], poi_data["poi_df"], TO_AGGREGATE, ADD_COLUMNS, TARGET_DISTANCE, poi_data["spatial_index"], poi_data["category_matrix"])
+        results[f"batch_{batch_size}"] = len(records) / (time.perf_counter() - start)
+
+    return results
+
 def generate_file_name(records):
-    name = ""
-    for record in records:
-        name += str(record["id"])
-    
-    hashed = hash(name)
+    """
+    Generate a stable name for the output of a batch, the same for every delivery of the same listings
+    """
+    name = ",".join(sorted(str(record["id"]) for record in records))
+
+    hashed = hashlib.sha256(name.encode("utf-8")).hexdigest()
 
     return hashed
 
-def upload_to_s3(client, file_path, object_name):
+def object_exists(client, object_key):
+    try:
+        client.head_object(Bucket="stonehenge-fyp", Key=object_key)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
 
+def get_part_key(object_name):
     # Get current date to store data under this key
     current_date = datetime.today().strftime('%Y-%m-%d')
-    final_key = f"blended/{current_date}/parts/{object_name}"
+    return f"blended/{current_date}/parts/{object_name}"
+
+def upload_to_s3(client, file_path, object_name):
+
+    final_key = get_part_key(object_name)
 
     with open(file_path, "rb") as f:
         client.upload_fileobj(f, "stonehenge-fyp", final_key)
@@ -309,4 +515,22 @@ def download_s3_object(client, bucket, file_name):
     with open(f"/tmp/{file_name}", "wb") as file:
         client.download_fileobj(Bucket=bucket, Key=object_key, Fileobj=file)
 
-    return "Successfully downloaded"
\ No newline at end of file
+    return "Successfully downloaded"
+
+# Local Benchmark
+if __name__ == "__main__":
+
+    # Synthetic POIs spread over the Tokyo rectangle used by the Geoapify scraper, and listings clustered in the centre
+    rng = np.random.default_rng(0)
+    poi_count = 50000
+    poi_df = pd.DataFrame({
+        "latitude": rng.uniform(35.510811, 35.900432, poi_count),
+        "longitude": rng.uniform(138.951375, 139.940329, poi_count),
+        "categories": [str(list(rng.choice(TO_AGGREGATE, 3))) for _ in range(poi_count)],
+        "rating": rng.choice([np.nan, 3.5, 4.0, 4.5], poi_count),
+        "opening_hours": rng.choice([np.nan, "Monday: 11:00 AM – 8:00 PM,Tuesday: Closed"], poi_count),
+    })
+    records = [{"latitude": lat, "longitude": lon} for lat, lon in zip(rng.normal(35.69, 0.01, 1000), rng.normal(139.70, 0.01, 1000))]
+
+    poi_data = prepare_poi_data(poi_df, TO_AGGREGATE)
+    print(json.dumps(benchmark_batch_sizes(records, poi_data), indent=4))
@@ -1,14 +1,38 @@
+import os
 import boto3
+import numpy as np
 import pandas as pd
 import json
+import time
+import gzip
+import base64
+from botocore.exceptions import ClientError
+from datetime import datetime
+from blend_distance import TARGET_DISTANCE, getDistancesFromLatLonInKm
+from blend_history import get_previous_blend_date
+from sqs_batch import publish_messages
+
+# Largest radius aggregated by the data blender, a POI change further than this from a listing cannot affect its record
+MAX_TARGET_DISTANCE = max(TARGET_DISTANCE) # in km
+
+# Listings packed into one message, bounded so that a message stays under the SQS message size limit
+LISTINGS_PER_MESSAGE = int(os.environ.get("LISTINGS_PER_MESSAGE", "20"))
+COMPRESS_MESSAGES = os.environ.get("COMPRESS_MESSAGES", "false") == "true"
+SQS_MESSAGE_BYTES = 256 * 1024
+
+# Publish throughput of the current invocation
+publish_stats = {"messages": 0, "seconds": 0.0}
 
 def handler(event, context):
     bucket = event["Records"][0]["s3"]["bucket"]["name"]
-    message = main(bucket)
+    # "incremental" only publishes the listings affected by the POI changes since the previous blend
+    message = main(bucket, os.environ.get("BLEND_MODE", "full"))
 
-    return {"message": message}
+    return {"message": message, "publish_stats": dict(publish_stats)}
+
+def main(bucket, mode="full"):
+    publish_stats.update({"messages": 0, "seconds": 0.0})
 
-def main(bucket):
     # Initialise AWS service clients
     sqs_client = boto3.client("sqs")
     s3_client = boto3.client("s3")
@@ -19,6 +43,13 @@ def main(bucket):
     # Get SQS Queue URL
     queue_url = sqs_client.get_queue_url(QueueName="Data-Blender")["QueueUrl"]
 
+    # Diff the POI snapshot against the one used by the previous blend
+    changes = None
+    if mode == "incremental":
+        changes = get_poi_changes(s3_client, bucket)
+        if changes is None:
+            print("No previous blend to compare against, publishing every listing")
+
     # Download listing data from S3
     for file_name in file_names:
         download_s3_object(s3_client, bucket, file_name)
@@ -26,16 +57,64 @@ def main(bucket):
         df = pd.read_csv(f"/tmp/{file_name}")
         df = df.drop_duplicates(subset=['longitude','latitude'])
 
+        # Only re-blend the new listings and the listings near a changed POI, the others are carried forward by the merger
+        if changes is not None:
+            blended = pd.Series(list(zip(df['longitude'], df['latitude'])), index=df.index).isin(changes["blended_coordinates"])
+            df = df[~blended | is_near_changes(df, changes["changed_coordinates"], MAX_TARGET_DISTANCE)]
+            print(f"{file_name}: publishing {len(df)} listings, {int(blended.sum())} previously blended")
+
         df["source"] = file_name
-        for index, record in df.iterrows():
-            body = json.dumps(dict(record))
-            # Publish each listing record to queue in separate messages
-            sqs_client.send_message(QueueUrl=queue_url, MessageBody=body)
+        # Publish the listing records to queue, packed several to a message
+        bodies = pack_listings([json.dumps(record) for record in df.to_dict("records")])
+        start = time.perf_counter()
+        publish_stats["messages"] += publish_messages(sqs_client, queue_url, bodies)
+        publish_stats["seconds"] += time.perf_counter() - start
+
+    rate = publish_stats["messages"] / publish_stats["seconds"] if publish_stats["seconds"] else 0.0
+    publish_stats["messages_per_second"] = rate
+    print(f"Published {publish_stats['messages']} messages in {publish_stats['seconds']:.2f}s ({rate:.1f} messages/s)")
 
     return "Function finished"
 
-def download_s3_object(client, bucket, file_name):
-    object_key = f"listings/{file_name}"
+def pack_listings(listings, listings_per_message=LISTINGS_PER_MESSAGE, compress=COMPRESS_MESSAGES, max_bytes=SQS_MESSAGE_BYTES):
+    """
+    Pack serialised listing records into message bodies that the data blender unpacks
+    Expected input:
+    - listings: the list of listing records, each serialised to JSON
+    - listings_per_message: the largest number of listings in one message
+    - compress: whether to gzip the listings of each message, as base64 text
+    - max_bytes: the largest size of one message body
+    Expected output:
+    - the list of message bodies, either {"listings": [...]} or {"compressed_listings": "..."}
+    """
+    # Group the listings by count and size, leaving room for the gzip header and base64 expansion when compressing
+    if compress:
+        max_bytes = (max_bytes - 1024) * 3 // 4
+    groups = []
+    group, group_bytes = [], 0
+    envelope_bytes = len('{"listings": []}')
+    for listing in listings:
+        listing_bytes = len(listing.encode("utf-8")) + 2
+        if group and (len(group) == listings_per_message or envelope_bytes + group_bytes + listing_bytes > max_bytes):
+            groups.append(group)
+            group, group_bytes = [], 0
+        group.append(listing)
+        group_bytes += listing_bytes
+    if group:
+        groups.append(group)
+
+    bodies = []
+    for group in groups:
+        packed = "[" + ", ".join(group) + "]"
+        if compress:
+            bodies.append(json.dumps({"compressed_listings": base64.b64encode(gzip.compress(packed.encode("utf-8"))).decode("ascii")}))
+        else:
+            bodies.append('{"listings": ' + packed + '}')
+
+    return bodies
+
+def download_s3_object(client, bucket, file_name, prefix="listings/"):
+    object_key = f"{prefix}{file_name}"
     with open(f"/tmp/{file_name}", "wb") as file:
         client.download_fileobj(Bucket=bucket, Key=object_key, Fileobj=file)
 
@@ -72,4 +151,99 @@ def list_all_s3_objects(client, bucket):
         if file_name != "":
             file_names.append(file_name)
 
-    return file_names
\ No newline at end of file
+    return file_names
+
+def get_poi_changes(client, bucket):
+    """
+    Diff the current POI snapshot against the snapshot of the previous blend
+    Expected input:
+    - client: the S3 client
+    - bucket: the bucket containing the POI snapshots and the blended data
+    Expected output:
+    - a dictionary containing the coordinates of the listings in the previous blend and the coordinates of the changed POIs,
+      or None if there is no previous blend with a POI snapshot to compare against
+    """
+    current_date = datetime.today().strftime("%Y-%m-%d")
+    previous_date = get_previous_blend_date(client, bucket, current_date)
+    if previous_date is None:
+        return None
+
+    try:
+        previous_df = load_poi_snapshot(client, bucket, f"poi-api/{previous_date}/")
+    except ClientError:
+        return None
+    current_df = load_poi_snapshot(client, bucket, f"poi-api/{current_date}/")
+
+    # Compare the POIs present in both snapshots column by column, treating two missing values as equal
+    added = current_df.index.difference(previous_df.index)
+    removed = previous_df.index.difference(current_df.index)
+    common = current_df.index.intersection(previous_df.index)
+    before, after = previous_df.loc[common], current_df.loc[common]
+    modified = common[((before != after) & ~(before.isna() & after.isna())).any(axis=1).to_numpy()]
+    print(f"POI changes since {previous_date}: {len(added)} added, {len(removed)} removed, {len(modified)} modified")
+
+    # A modified POI affects the listings around both its previous and its current coordinates
+    changed_coordinates = np.concatenate([
+        current_df.loc[added.union(modified), ["latitude", "longitude"]].to_numpy(),
+        previous_df.loc[removed.union(modified), ["latitude", "longitude"]].to_numpy(),
+    ])
+
+    download_s3_object(client, bucket, "merged_parts.csv", f"blended/{previous_date}/")
+    blended_df = pd.read_csv("/tmp/merged_parts.csv", usecols=["longitude", "latitude"])
+
+    return {
+        "blended_coordinates": set(zip(blended_df["longitude"], blended_df["latitude"])),
+        "changed_coordinates": changed_coordinates[~np.isnan(changed_coordinates).any(axis=1)],
+    }
+
+def load_poi_snapshot(client, bucket, prefix):
+    """
+    Load the columns of a POI snapshot written by the POI data merger that affect the blended records
+    Expected input:
+    - client: the S3 client
+    - bucket: the bucket containing the snapshot
+    - prefix: the poi-api/{date}/ prefix of the snapshot
+    Expected output:
+    - a dataframe indexed by place id with the columns 'latitude', 'longitude', 'rating', 'user_ratings_total',
+      'opening_hours' and 'categories', where the categories are a sorted comma separated string
+    """
+    download_s3_object(client, bucket, "full_poi_results.npz", prefix)
+    with np.load("/tmp/full_poi_results.npz") as snapshot:
+        opening_hours = np.append(snapshot["opening_hours_values"].astype(object), np.nan)[snapshot["opening_hours_codes"]]
+        tokens = snapshot["category_vocabulary"].astype(object)[snapshot["category_codes"]]
+        offsets = snapshot["category_offsets"]
+        categories = [",".join(sorted(tokens[start:end])) for start, end in zip(offsets[:-1], offsets[1:])]
+
+        return pd.DataFrame({
+            "latitude": snapshot["latitude"],
+            "longitude": snapshot["longitude"],
+            "rating": snapshot["rating"],
+            "user_ratings_total": snapshot["user_ratings_total"],
+            "opening_hours": opening_hours,
+            "categories": categories,
+        }, index=pd.Index(snapshot["place_id"].astype(str), name="place_id"))
+
+def is_near_changes(df, changed_coordinates, target_distance, block_size=1000):
+    """
+    Check which listings are within the target distance of a changed POI
+    Expected input:
+    - df: a dataframe with columns 'latitude' and 'longitude'
+    - changed_coordinates: an array of the latitudes and longitudes of the changed POIs
+    - target_distance: the target distance in km
+    - block_size: the number of listings compared against every changed POI at once
+    Expected output:
+    - a boolean series aligned with df
+    """
+    near = np.zeros(len(df), dtype=bool)
+    if len(changed_coordinates) == 0:
+        return pd.Series(near, index=df.index)
+
+    poi_lat_rad = np.radians(changed_coordinates[:, 0])
+    poi_lon_rad = np.radians(changed_coordinates[:, 1])
+    lat = df['latitude'].to_numpy(dtype=float)
+    lon = df['longitude'].to_numpy(dtype=float)
+    for start in range(0, len(df), block_size):
+        distances = getDistancesFromLatLonInKm(lat[start:start + block_size], lon[start:start + block_size], poi_lat_rad, poi_lon_rad)
+        near[start:start + block_size] = (distances <= target_distance).any(axis=1)
+
+    return pd.Series(near, index=df.index)
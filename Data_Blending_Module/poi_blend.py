@@ -1,110 +1,22 @@
 import pandas as pd
+import numpy as np
 import math
 import json
 import os
-def getLandmarksWithinDistance(df, target_distance, lat, lon):
-    """ 
-    Get the landmarks within the target distance from the given dataframe
-    Expected input: 
-    - a dataframe with columns 'latitude' and 'longitude'
-    - target_distance: the target distance in km
-    - lat: latitude of the current location
-    - lon: longitude of the current location
-    Expected output: 
-    - a dataframe with columns 'latitude' and 'longitude' and 'distance'
-    """
-    
-    # Get the landmarks within the target distance
-    df['distance'] = df.apply(lambda x: getDistanceFromLatLonInKm(lat, lon, x['latitude'], x['longitude']), axis=1)
-    df = df[df['distance'] <= target_distance]
-    return df
-  
-def get_category_ls(str_arr,cur_set=set()):
-    """
-    Get the list of categories from the string
-    Expected input:
-    - str_arr: the string of categories
-    Expected output:
-    - a list of categories
-    """
-    for i in str_arr.replace("[", "").replace("]", "").replace("'", "").replace(".", ",").replace(" ", "").split(","):
-        cur_set.add(i)
-    return cur_set
+import multiprocessing
+from multiprocessing import shared_memory
+from blend_common import getLandmarksWithinDistance, getLandmarkPositionsWithinDistance, build_spatial_index, build_category_matrix, parse_opening_hours, get_total_operating_hours
 
-def getDistanceFromLatLonInKm(lat1,lon1,lat2,lon2):
-    """ 
-    Get the distance between 2 coordinates
-    Expected input: 
-    - lat1: latitude of the first coordinate
-    - lon1: longitude of the first coordinate
-    - lat2: latitude of the second coordinate
-    - lon2: longitude of the second coordinate
-    Expected output: 
-    - the distance between the 2 coordinates in km
-    """
-    
-    deg2rad = lambda x: x * (math.pi/180)
-    R = 6371 # Radius of the earth in km
-    dLat = deg2rad(lat2-lat1)  # deg2rad below
-    dLon = deg2rad(lon2-lon1) 
-    a = math.sin(dLat/2) * math.sin(dLat/2) + math.cos(deg2rad(lat1)) * math.cos(deg2rad(lat2)) * math.sin(dLon/2) * math.sin(dLon/2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    d = R * c # Distance in km
-    return d
-  
-def categorical_aggregation(category,df):
-    """
-    Get the category string, filter out the points from the df and aggregate summary statistics.
-    Expected input:
-    - category: string
-    - df: A pandas DataFrame containing values that meets the search radius criteria
-    Expected output:
-    - count: integer
-    - average: rating
-    """
-    
-    filtered_df = df[df.categories.apply(lambda x: category in x)]
-    return filtered_df
+# Columns of the POI table read by generate_record
+BLEND_COLUMNS = ["name", "rating", "user_ratings_total", "weekly_opening_hours"]
 
-def convert_to_24hr(string):
-    """
-    Convert a string in the format of "11:00 AM" to hours elapsed since midnight:
-    Expected input: "11:00 AM"
-    Expected output: 11
-    """
-    time = 0
-    if string.split(":")[0] == "12":
-        string = "0"+string[2:]
-    if "PM" in string:
-        time += int(string.split(":")[0]) + 12
-    else:
-        time += int(string.split(":")[0])
-    
-    return time+int(string.split(":")[1].split(" ")[0])/60
-    
-def get_total_operating_hours(string):
-    """
-    Get the total operating hours from a string:
-    Expected input: "Monday: 11:00 AM – 8:00 PM,Tuesday: 11:00 AM – 8:00 PM,Wednesday: 11:00 AM – 8:00 PM,Thursday: 11:00 AM – 8:00 PM,Friday: 11:00 AM – 8:00 PM,Saturday: 11:00 AM – 8:00 PM,Sunday: 11:00 AM – 8:00 PM"
-    Expected output: 63
-    """
-    # Initialize the total hours
-    total_hours = 0
-    string=string.replace(" ", " ").replace("–", "-").replace("\u202f"," ")
-    
-    # Split the string by comma
-    weekdays = string.split(",")
-    for day_str in weekdays:
-        try:
-            time_str = day_str.split(":",maxsplit=1)[1].strip()
-            start_time = time_str.split("-")[0].strip()
-            end_time = time_str.split("-")[1].strip()
-            total_hours += convert_to_24hr(end_time) - convert_to_24hr(start_time)
-        except:
-            continue
-    return total_hours
+# Every column that generate_record can fill for a category and target distance
+RECORD_COLUMNS = ["total_count","average_rating","nearest_name","nearest_rating","nearest_rating_count","nearest_opening_hours","highest_name","highest_rating","highest_rating_count","highest_opening_hours"]
 
-def generate_record(lon,lat,poi_df,to_aggregate,add_columns,target_distances=[1,3]):
+# POI table attached by each worker of the process pool used by transform
+blend_worker_state = {}
+
+def generate_record(lon,lat,poi_df,to_aggregate,add_columns,target_distances=[1,3],spatial_index=None,category_matrix=None):
   """
   Generate a record for the current listing
   Expected input:
@@ -114,6 +26,8 @@ def generate_record(lon,lat,poi_df,to_aggregate,add_columns,target_distances=[1,
   - to_aggregate: the list of categories to aggregate
   - add_columns: the list of columns to add
   - target_distances: the target distance in km
+  - spatial_index: optional index generated by build_spatial_index from poi_df
+  - category_matrix: optional matrix generated by build_category_matrix from poi_df and to_aggregate
   Expected output:
   - a dictionary containing the aggregated values for the current listing
   """
@@ -122,47 +36,64 @@ def generate_record(lon,lat,poi_df,to_aggregate,add_columns,target_distances=[1,
   record_dict["latitude"] = lat
   record_dict["longitude"] = lon
   
+  if spatial_index is None:
+    spatial_index = build_spatial_index(poi_df)
+  if category_matrix is None:
+    category_matrix = build_category_matrix(poi_df['categories'], to_aggregate)
+  if 'weekly_opening_hours' not in poi_df:
+    poi_df['weekly_opening_hours'] = parse_opening_hours(poi_df['opening_hours'])
+  
+  names = poi_df['name'].to_numpy()
+  rating_counts = poi_df['user_ratings_total'].to_numpy()
+  opening_hours = poi_df['weekly_opening_hours'].to_numpy(dtype=float)
+  
   for dist in target_distances:
     # Get the landmarks within the target distance
-    result_df = getLandmarksWithinDistance(poi_df, dist, lat, lon)
+    positions, distances = getLandmarkPositionsWithinDistance(spatial_index, dist, lat, lon)
+    if len(positions) == 0:
+        continue
+    matches = category_matrix[positions]
+    ratings = poi_df['rating'].to_numpy(dtype=float)[positions]
     
-    relevant_categories = set()
-    for i in range(len(result_df)):
-        relevant_categories = get_category_ls(result_df.iloc[i]['categories'],relevant_categories)
+    # Aggregate the summary statistics of every category at once
+    counts = matches.sum(axis=0)
+    rating_totals = matches.T @ np.nan_to_num(ratings)
+    rating_valid = matches.T @ (~np.isnan(ratings)).astype(int)
+    # Ties are resolved by taking the first landmark, like the per-category queries did
+    nearest = np.where(matches, distances[:, np.newaxis], np.inf).argmin(axis=0)
+    highest = np.where(matches, ratings[:, np.newaxis], -np.inf).argmax(axis=0)
     
-    for cat in relevant_categories:
-        if cat in to_aggregate:
-            # print("Aggregating for category: {}".format(cat))
-            # Aggregate the summary statistics
-            filtered_df = categorical_aggregation(cat,result_df)
-            # Get the total count
-            record_dict[f"{dist}km_{cat}_total_count"] = len(filtered_df)
-
-            if len(filtered_df) == 0:
-                continue
-            # Get the average rating
-            record_dict[f"{dist}km_{cat}_average_rating"] = filtered_df['rating'].mean()
-            # Get the nearest landmark
-            nearest_landmark = filtered_df.query("distance == distance.min()")
-            record_dict[f"{dist}km_{cat}_nearest_name"] = nearest_landmark.name.values[0]
-            record_dict[f"{dist}km_{cat}_nearest_rating"] = nearest_landmark.rating.values[0]
-            record_dict[f"{dist}km_{cat}_nearest_rating_count"] = nearest_landmark.user_ratings_total.values[0]
-            if not nearest_landmark.opening_hours.isnull().values.any():
-                # print(nearest_landmark.opening_hours.values[0])
-                record_dict[f"{dist}km_{cat}_nearest_opening_hours"] = get_total_operating_hours(nearest_landmark.opening_hours.values[0])
-            
-            if filtered_df['rating'].isnull().values.any():
-                continue
-            # Get the highest rated landmark
-            highest_rating_landmark = filtered_df.query("rating == rating.max()")
-            record_dict[f"{dist}km_{cat}_highest_name"] = highest_rating_landmark.name.values[0]
-            record_dict[f"{dist}km_{cat}_highest_rating"] = highest_rating_landmark.rating.values[0]
-            record_dict[f"{dist}km_{cat}_highest_rating_count"] = highest_rating_landmark.user_ratings_total.values[0]
-            if not highest_rating_landmark.opening_hours.isnull().values.any():
-                record_dict[f"{dist}km_{cat}_highest_opening_hours"] = get_total_operating_hours(highest_rating_landmark.opening_hours.values[0])
+    for k, cat in enumerate(to_aggregate):
+        if counts[k] == 0:
+            continue
+        # print("Aggregating for category: {}".format(cat))
+        # Get the total count
+        record_dict[f"{dist}km_{cat}_total_count"] = int(counts[k])
+        # Get the average rating
+        record_dict[f"{dist}km_{cat}_average_rating"] = rating_totals[k] / rating_valid[k] if rating_valid[k] else math.nan
+        # Get the nearest landmark
+        nearest_landmark = positions[nearest[k]]
+        record_dict[f"{dist}km_{cat}_nearest_name"] = names[nearest_landmark]
+        record_dict[f"{dist}km_{cat}_nearest_rating"] = ratings[nearest[k]]
+        record_dict[f"{dist}km_{cat}_nearest_rating_count"] = rating_counts[nearest_landmark]
+        # Only keep the opening hours if every landmark tied for the nearest has them
+        tied = matches[:, k] & (distances == distances[nearest[k]])
+        if not np.isnan(opening_hours[positions[tied]]).any():
+            record_dict[f"{dist}km_{cat}_nearest_opening_hours"] = opening_hours[nearest_landmark]
+        
+        if rating_valid[k] < counts[k]:
+            continue
+        # Get the highest rated landmark
+        highest_rating_landmark = positions[highest[k]]
+        record_dict[f"{dist}km_{cat}_highest_name"] = names[highest_rating_landmark]
+        record_dict[f"{dist}km_{cat}_highest_rating"] = ratings[highest[k]]
+        record_dict[f"{dist}km_{cat}_highest_rating_count"] = rating_counts[highest_rating_landmark]
+        tied = matches[:, k] & (ratings == ratings[highest[k]])
+        if not np.isnan(opening_hours[positions[tied]]).any():
+            record_dict[f"{dist}km_{cat}_highest_opening_hours"] = opening_hours[highest_rating_landmark]
   return record_dict
   
-def transform(poi_df,listing_df,to_aggregate,add_columns,target_distance, listing_file_name):
+def transform(poi_df,listing_df,to_aggregate,add_columns,target_distance, listing_file_name, workers=1, progress_every=1000, chunk_size=500):
     """
     Transform the data
     Expected input:
@@ -172,43 +103,252 @@ def transform(poi_df,listing_df,to_aggregate,add_columns,target_distance, listin
     - add_columns: the list of columns to add
     - target_distance: the target distance in km
     - listing_file_name: the name of the listing file
+    - workers: the number of processes generating the records, the POI arrays are shared between them
+    - progress_every: the number of records between two progress lines
+    - chunk_size: the number of buildings whose listings are written to the output file together
     Expected output:
-    - An output file containing the aggregated values for each listing in a csv format
+    - An output file containing the aggregated values for each listing in a csv format, written chunk by chunk with the
+      listings of each chunk in their original order. A checkpoint of the completed buildings is kept next to it
+      until the file is complete, so that an interrupted run of the same listing file resumes where it stopped
     """
     
-    output = []
-    record_no = 0
+    output_path = f"./output/{listing_file_name}.csv"
+    checkpoint_path = f"./output/{listing_file_name}.checkpoint.json"
+    
+    # Make sure the name,longitude and latitude are the first 3 columns, followed by every column a record can have
+    record_columns = get_record_columns(to_aggregate, add_columns, target_distance)
+    cols = listing_df.columns.tolist() + [col for col in record_columns if col not in ['longitude', 'latitude']]
+    cols = ['asset_name', 'longitude', 'latitude'] + [col for col in cols if col not in ['asset_name', 'longitude', 'latitude']]
     
-    # Only iterate through the unique longitudes and latitudes
-    building_df = listing_df.drop_duplicates(subset=["longitude","latitude"])
+    # Resume from the checkpoint, or start a new output file with only the header
+    completed = load_checkpoint(checkpoint_path, output_path)
+    if completed is None:
+        completed = set()
+        pd.DataFrame(columns=cols).to_csv(output_path, index=False)
+        save_checkpoint(checkpoint_path, output_path, completed)
+    
+    # Parse the opening hours, build the spatial index and category matrix once for all the listings in this file
+    if 'weekly_opening_hours' not in poi_df:
+        poi_df['weekly_opening_hours'] = parse_opening_hours(poi_df['opening_hours'])
+    spatial_index = build_spatial_index(poi_df)
+    category_matrix = build_category_matrix(poi_df['categories'], to_aggregate)
+    
+    # Only iterate through the unique longitudes and latitudes that are not completed yet, each building is keyed by its
+    # group number rather than its coordinates, as NaN coordinates never compare equal to themselves
+    listing_positions = get_listing_positions(listing_df)
+    coordinates = [(building, listing_df['longitude'].iat[positions[0]], listing_df['latitude'].iat[positions[0]]) for building, positions in enumerate(listing_positions) if building not in completed]
+    if completed:
+        print("Resuming [{}]: {}/{} records already completed".format(listing_file_name,len(listing_positions)-len(coordinates),len(listing_positions)))
+    
+    if workers > 1:
+        # Copy the POI arrays into shared memory once, every worker reads them in place
+        blocks, worker_args = share_poi_arrays(poi_df, spatial_index, category_matrix)
+        pool = multiprocessing.Pool(workers, initializer=init_blend_worker, initargs=(worker_args, to_aggregate, add_columns, target_distance))
+        # imap gives the records back in the order of the buildings
+        records = pool.imap(blend_building, coordinates, chunksize=max(1, min(100, len(coordinates) // (workers * 4))))
+    else:
+        records = ((building, generate_record(lon,lat,poi_df,to_aggregate,add_columns,target_distance,spatial_index,category_matrix)) for building, lon, lat in coordinates)
     
     # Iterate through the listings
-    for i in range(len(building_df)):
-        record_no +=1
-        print("Processing record [{}]: {}/{}".format(listing_file_name,record_no,len(building_df)))
-        # Get the current listing
-        current_listing = listing_df.iloc[i]
-        # Get the longitude and latitude
-        lon = current_listing['longitude']
-        lat = current_listing['latitude']
+    chunk = []
+    try:
+        for i, record in enumerate(records, start=1):
+            chunk.append(record)
+            if i % progress_every == 0 or i == len(coordinates):
+                print("Processing record [{}]: {}/{}".format(listing_file_name,i,len(coordinates)))
+            if len(chunk) == chunk_size or i == len(coordinates):
+                write_chunk(output_path, listing_df, listing_positions, chunk, record_columns, cols)
+                completed.update(building for building, _ in chunk)
+                save_checkpoint(checkpoint_path, output_path, completed)
+                chunk = []
+    finally:
+        if workers > 1:
+            pool.terminate()
+            pool.join()
+            for block in blocks:
+                block.close()
+                block.unlink()
+    
+    # The output file is complete, so the checkpoint is no longer needed
+    os.remove(checkpoint_path)
 
-        # Generate the record
-        record = generate_record(lon,lat,poi_df,to_aggregate,add_columns,target_distance)
-        output.append(record)
-        
-    # Convert the output to a dataframe
-    output_df = pd.DataFrame(output)
- 
-    # Combine such that new_df has the same number of rows as listing_df by matching the longitude and latitude
-    new_df = pd.merge(listing_df,output_df.drop_duplicates(subset=["longitude","latitude"]),on=["longitude","latitude"],how="left")
+def get_record_columns(to_aggregate, add_columns, target_distances):
+    """
+    Get the columns of the records generated by generate_record, in a fixed order
+    Expected input:
+    - to_aggregate: the list of categories to aggregate
+    - add_columns: the list of columns to add
+    - target_distances: the target distance in km
+    Expected output:
+    - the list of columns, starting with the columns that every record has
+    """
+    columns = [f"{dist}km_{cat}_{col}" for cat in to_aggregate for col in add_columns for dist in target_distances] + ["latitude", "longitude"]
+    columns += [f"{dist}km_{cat}_{col}" for cat in to_aggregate for col in RECORD_COLUMNS for dist in target_distances]
+    return list(dict.fromkeys(columns))
+
+def get_listing_positions(listing_df):
+    """
+    Group the listings by building
+    Expected input:
+    - listing_df: the dataframe containing the listing details
+    Expected output:
+    - the row positions of the listings of each building, indexed by the building number. Buildings are numbered in
+      the order of their first listing, listings with a NaN coordinate are grouped like any other coordinates
+    """
+    buildings = listing_df.groupby(["longitude","latitude"], sort=False, dropna=False).ngroup().to_numpy()
+    order = np.argsort(buildings, kind="stable")
+    return np.split(order, np.flatnonzero(np.diff(buildings[order])) + 1) if len(order) else []
+
+def write_chunk(output_path, listing_df, listing_positions, records, record_columns, cols):
+    """
+    Append the listings of a chunk of buildings to the output file
+    Expected input:
+    - output_path: the path of the output file
+    - listing_df: the dataframe containing the listing details
+    - listing_positions: the row positions of the listings of each building, returned by get_listing_positions
+    - records: the building numbers and records generated for the buildings of the chunk
+    - record_columns: the columns returned by get_record_columns
+    - cols: the columns of the output file
+    """
+    building_positions = [listing_positions[building] for building, _ in records]
+    positions = np.concatenate(building_positions)
+    record_rows = np.repeat(np.arange(len(records)), [len(building) for building in building_positions])
+    order = np.argsort(positions, kind="stable")
+    output_df = pd.DataFrame([record for _, record in records], columns=record_columns).drop(columns=["longitude","latitude"])
     
-    # Make sure the name,longitude and latitude are the first 3 columns
-    cols = new_df.columns.tolist()
-    # print(cols)
-    df= new_df[['asset_name', 'longitude', 'latitude'] + [col for col in cols if col not in ['asset_name', 'longitude', 'latitude']]]
+    # Combine such that the chunk has the same number of rows as its listings, in their original order
+    new_df = pd.concat([listing_df.iloc[positions[order]].reset_index(drop=True), output_df.iloc[record_rows[order]].reset_index(drop=True)], axis=1)
+    with open(output_path, "a", newline="") as file:
+        new_df.reindex(columns=cols).to_csv(file, header=False, index=False)
+        file.flush()
+        os.fsync(file.fileno())
+
+def load_checkpoint(checkpoint_path, output_path):
+    """
+    Load the checkpoint of an interrupted transform, dropping anything written to the output file after it
+    Expected input:
+    - checkpoint_path: the path of the checkpoint file
+    - output_path: the path of the output file
+    Expected output:
+    - the set of completed building numbers, or None if there is nothing to resume
+    """
+    if not os.path.exists(checkpoint_path) or not os.path.exists(output_path):
+        return None
+    with open(checkpoint_path) as file:
+        checkpoint = json.load(file)
+    # Checkpoints keyed by coordinates cannot be matched to the buildings, the file is written again
+    if "completed_buildings" not in checkpoint:
+        return None
     
-    # Save the output
-    df.to_csv(f"./output/{listing_file_name}.csv",index=False)
+    # A chunk may have been partly written when the run was interrupted
+    with open(output_path, "r+b") as file:
+        file.truncate(checkpoint["output_bytes"])
+    return set(checkpoint["completed_buildings"])
+
+def save_checkpoint(checkpoint_path, output_path, completed):
+    """
+    Save the completed buildings with the size of the output file that holds their listings
+    Expected input:
+    - checkpoint_path: the path of the checkpoint file
+    - output_path: the path of the output file
+    - completed: the set of completed building numbers
+    """
+    checkpoint = {"output_bytes": os.path.getsize(output_path), "completed_buildings": sorted(int(building) for building in completed)}
+    
+    # Replace the checkpoint in one step so that an interruption never leaves it half written
+    with open(f"{checkpoint_path}.tmp", "w") as file:
+        json.dump(checkpoint, file)
+    os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+def share_poi_arrays(poi_df, spatial_index, category_matrix):
+    """
+    Copy the POI arrays read by generate_record into shared memory blocks
+    Expected input:
+    - poi_df: the dataframe containing the POI details, with a 'weekly_opening_hours' column
+    - spatial_index: the index generated by build_spatial_index from poi_df
+    - category_matrix: the matrix generated by build_category_matrix from poi_df
+    Expected output:
+    - the list of shared memory blocks, to be closed and unlinked by the caller once the workers are done
+    - the arguments of init_blend_worker describing how to attach the POI table
+    """
+    cells = list(spatial_index["cells"].items())
+    arrays = {
+        "lat_rad": spatial_index["lat_rad"],
+        "lon_rad": spatial_index["lon_rad"],
+        "cell_positions": np.concatenate([bucket for _, bucket in cells]) if cells else np.empty(0, dtype=np.int64),
+        "category_matrix": category_matrix,
+    }
+    # Text columns such as the POI names cannot be placed in shared memory, they are sent to each worker once
+    columns = {}
+    for column in BLEND_COLUMNS:
+        values = pd.to_numeric(poi_df[column], errors='coerce') if column != "name" else poi_df[column]
+        if pd.api.types.is_numeric_dtype(values):
+            arrays[column] = values.to_numpy()
+        else:
+            columns[column] = values.to_numpy()
+    
+    blocks = []
+    shared_arrays = {}
+    for key, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        shared_arrays[key] = (block.name, array.shape, array.dtype.str)
+    
+    # The cells are rebuilt by each worker as slices of the shared cell positions
+    cell_bounds = np.cumsum([0] + [len(bucket) for _, bucket in cells])
+    cell_slices = [(key, int(start), int(end)) for (key, _), start, end in zip(cells, cell_bounds[:-1], cell_bounds[1:])]
+    
+    return blocks, {"shared_arrays": shared_arrays, "columns": columns, "cell_deg": spatial_index["cell_deg"], "cell_slices": cell_slices}
+
+def init_blend_worker(worker_args, to_aggregate, add_columns, target_distance):
+    """
+    Attach a process pool worker to the POI arrays shared by share_poi_arrays
+    Expected input:
+    - worker_args: the arguments returned by share_poi_arrays
+    - to_aggregate: the list of categories to aggregate
+    - add_columns: the list of columns to add
+    - target_distance: the target distance in km
+    """
+    blocks = []
+    arrays = {}
+    for key, (name, shape, dtype) in worker_args["shared_arrays"].items():
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    
+    cell_positions = arrays.pop("cell_positions")
+    spatial_index = {
+        "cell_deg": worker_args["cell_deg"],
+        "cells": {key: cell_positions[start:end] for key, start, end in worker_args["cell_slices"]},
+        "lat_rad": arrays.pop("lat_rad"),
+        "lon_rad": arrays.pop("lon_rad"),
+    }
+    category_matrix = arrays.pop("category_matrix")
+    poi_df = pd.DataFrame({**arrays, **worker_args["columns"]}, copy=False)
+    
+    # The blocks are kept referenced so that the arrays stay valid for the life of the worker
+    blend_worker_state.update({
+        "blocks": blocks,
+        "poi_df": poi_df,
+        "spatial_index": spatial_index,
+        "category_matrix": category_matrix,
+        "to_aggregate": to_aggregate,
+        "add_columns": add_columns,
+        "target_distance": target_distance,
+    })
+
+def blend_building(coordinates):
+    """
+    Generate the record of a building in a process pool worker set up by init_blend_worker
+    Expected input:
+    - coordinates: the building number, longitude and latitude of the building
+    Expected output:
+    - the building number and a dictionary containing the aggregated values for the building
+    """
+    building, lon, lat = coordinates
+    state = blend_worker_state
+    return building, generate_record(lon,lat,state["poi_df"],state["to_aggregate"],state["add_columns"],state["target_distance"],state["spatial_index"],state["category_matrix"])
   
 def analyseCategories(df, min_occurences=1):
     """
@@ -263,6 +403,9 @@ if __name__ == "__main__":
     
     add_columns = ["total_count","average_rating","nearest_name","nearest_rating","nearest_rating_count","nearest_opening_hours","highest_name","highest_rating","highest_rating_count","nearest_opening_hours"]
     
+    # Number of processes sharing the POI arrays, set to 1 to run on a single core
+    workers = os.cpu_count()
+    
     # Iterate through the files and transform
     for file_name, file_path in mapping_input_files.items():
         # if file_name!= "test":
@@ -270,6 +413,6 @@ if __name__ == "__main__":
         # Read the listing data into a dataframe
         listing_df = pd.read_csv(file_path)
         # Transform the data
-        transform(poi_df,listing_df,to_aggregate,add_columns,target_distance, file_name)
+        transform(poi_df,listing_df,to_aggregate,add_columns,target_distance, file_name, workers)
     
     
\ No newline at end of file
@@ -34,6 +34,7 @@ module "sqs" {
 module "lambda" {
   source               = "./modules/lambda"
   GEOAPIFY_API_KEY     = var.GEOAPIFY_API_KEY
+  GEOAPIFY_API_KEYS    = var.GEOAPIFY_API_KEYS
   GOOGLE_API_KEY       = var.GOOGLE_API_KEY
   poi_sqs_arn          = module.sqs.poi_sqs_arn
   data_blender_sqs_arn = module.sqs.data_blender_sqs_arn
@@ -46,11 +46,36 @@ variable "blended_data_merger_function_name" {
   default = "Blended-Data-Merger"
 }
 
+variable "blend_mode" {
+  description = "Blending mode of the data blender queue publisher and blended data merger, either full or incremental"
+  type = string
+  default = "full"
+}
+
+variable "listings_per_message" {
+  description = "Number of listings packed into one message by the data blender queue publisher"
+  type = string
+  default = "20"
+}
+
+variable "compress_messages" {
+  description = "Whether the data blender queue publisher compresses the listings of each message, either true or false"
+  type = string
+  default = "false"
+}
+
 variable "GEOAPIFY_API_KEY" {
   description = "API Key for Geoapify"
   type = string
 }
 
+variable "GEOAPIFY_API_KEYS" {
+  description = "Comma separated API Keys for Geoapify, empty to use GEOAPIFY_API_KEY only"
+  type = string
+  default = ""
+  sensitive = true
+}
+
 variable "GOOGLE_API_KEY" {
   description = "API Key for Google Maps"
   type = string
@@ -71,3 +96,51 @@ variable "data_blender_sqs_arn" {
   description = "ARN of Data-Blender SQS queue from SQS Terraform module"
   type        = string
 }
+
+variable "geoapify_grid_size" {
+  description = "Number of tiles along each side of the bounding box, each scraped by its own Geoapify API scraper invocation per category"
+  type = string
+  default = "1"
+}
+
+variable "geoapify_api_key_count" {
+  description = "Number of Geoapify API keys the scraper tasks are spread over"
+  type = string
+  default = "1"
+}
+
+variable "geoapify_api_key_credits" {
+  description = "Geoapify credits each API key can spend per run"
+  type = string
+  default = "3000"
+}
+
+variable "geoapify_scraper_concurrency" {
+  description = "Reserved concurrency of the Geoapify API scraper, capping the scrapers running at once"
+  type = number
+  default = 5
+}
+
+variable "geoapify_requests_per_second" {
+  description = "Geoapify API requests per second allowed across every Geoapify API scraper running at once"
+  type = string
+  default = "5"
+}
+
+variable "gmaps_scraper_concurrency" {
+  description = "Reserved concurrency of the Google Maps API scraper, capping the scrapers running at once"
+  type = number
+  default = 5
+}
+
+variable "google_requests_per_second" {
+  description = "Google Maps API requests per second allowed across every Google Maps API scraper running at once"
+  type = string
+  default = "20"
+}
+
+variable "coalesce_sparse_categories" {
+  description = "Whether the Geoapify Lambda invoker scrapes sparse categories together in combined queries, either true or false"
+  type = string
+  default = "false"
+}
@@ -32,6 +32,17 @@ resource "aws_lambda_function" "geoapify_lambda_invoker" {
   source_code_hash = filebase64sha256("${path.module}/../../../API_Scraping_Module/geoapify_lambda_invoker.py")
   timeout       = 900
 
+  environment {
+    variables = {
+      "GRID_SIZE"                  = var.geoapify_grid_size
+      "GEOAPIFY_API_KEY_COUNT"     = var.geoapify_api_key_count
+      "GEOAPIFY_API_KEY_CREDITS"   = var.geoapify_api_key_credits
+      "COALESCE_SPARSE_CATEGORIES" = var.coalesce_sparse_categories
+      # Number of keys set in the scraper, checked against GEOAPIFY_API_KEY_COUNT without passing the keys themselves
+      "GEOAPIFY_API_KEYS_PROVIDED" = var.GEOAPIFY_API_KEYS == "" ? "1" : tostring(length(split(",", var.GEOAPIFY_API_KEYS)))
+    }
+  }
+
   depends_on = [
     aws_iam_role_policy_attachment.geoapify_lambda_invoker,
     aws_cloudwatch_log_group.geoapify_lambda_invoker,
@@ -69,14 +80,18 @@ resource "aws_lambda_function" "geoapify_api_scraper" {
   description      = "This function returns all the points of interests and their specific data according to the input category and location, obtained from Geoapify APIs."
   handler          = "geoapify_api_scraper.handler"
   runtime          = "python3.7"
-  source_code_hash = filebase64sha256("${path.module}/../../../API_Scraping_Module/geoapify_api_scraper.py")
+  source_code_hash = base64sha256(join("", [for file in ["geoapify_api_scraper.py", "http_client.py"] : filesha256("${path.module}/../../../API_Scraping_Module/${file}")]))
   timeout          = 900
   memory_size      = 1024
+  reserved_concurrent_executions = var.geoapify_scraper_concurrency
 
   # Name of environment variables to be passed to Lambda function, obtained from pipeline
   environment {
     variables = {
-      "GEOAPIFY_API_KEY" = var.GEOAPIFY_API_KEY
+      "GEOAPIFY_API_KEY"             = var.GEOAPIFY_API_KEY
+      "GEOAPIFY_API_KEYS"            = var.GEOAPIFY_API_KEYS
+      "GEOAPIFY_REQUESTS_PER_SECOND" = var.geoapify_requests_per_second
+      "GEOAPIFY_SCRAPER_CONCURRENCY" = tostring(var.geoapify_scraper_concurrency)
     }
   }
 
@@ -117,7 +132,7 @@ resource "aws_lambda_function" "gmaps_lambda_queue_publisher" {
   description      = "This function is triggered on each object uploaded to the stonehenge-fyp bucket, reading the object and publishing to an SQS queue for each record in the object."
   handler          = "gmaps_lambda_queue_publisher.handler"
   runtime          = "python3.9"
-  source_code_hash = filebase64sha256("${path.module}/../../../API_Scraping_Module/gmaps_lambda_queue_publisher.py")
+  source_code_hash = base64sha256(join("", [for file in ["gmaps_lambda_queue_publisher.py", "sqs_batch.py"] : filesha256("${path.module}/../../../API_Scraping_Module/${file}")]))
   timeout          = 900
 
   depends_on = [
@@ -164,13 +179,16 @@ resource "aws_lambda_function" "gmaps_api_scraper" {
   description      = "This function takes in a batch of records from an SQS queue and calls the Google Maps Places API for each record."
   handler          = "gmaps_api_scraper.handler"
   runtime          = "python3.7"
-  source_code_hash = filebase64sha256("${path.module}/../../../API_Scraping_Module/gmaps_api_scraper.py")
+  source_code_hash = base64sha256(join("", [for file in ["gmaps_api_scraper.py", "http_client.py"] : filesha256("${path.module}/../../../API_Scraping_Module/${file}")]))
   timeout          = 900
+  reserved_concurrent_executions = var.gmaps_scraper_concurrency
 
   # Name of environment variables to be passed to Lambda function, obtained from pipeline
   environment {
     variables = {
-      "GOOGLE_API_KEY" = var.GOOGLE_API_KEY
+      "GOOGLE_API_KEY"             = var.GOOGLE_API_KEY
+      "GOOGLE_REQUESTS_PER_SECOND" = var.google_requests_per_second
+      "GMAPS_SCRAPER_CONCURRENCY"  = tostring(var.gmaps_scraper_concurrency)
     }
   }
 
@@ -185,6 +203,7 @@ resource "aws_lambda_event_source_mapping" "poi_sqs_trigger" {
   event_source_arn                   = var.poi_sqs_arn
   function_name                      = aws_lambda_function.gmaps_api_scraper.arn
   maximum_batching_window_in_seconds = 120
+  function_response_types            = ["ReportBatchItemFailures"]
 }
 
 ## POI Data Merger
@@ -261,10 +280,19 @@ resource "aws_lambda_function" "data_blender_queue_publisher" {
   handler          = "data_blender_queue_publisher.handler"
   layers           = ["arn:aws:lambda:ap-southeast-1:336392948345:layer:AWSSDKPandas-Python39:5"]
   runtime          = "python3.9"
-  source_code_hash = filebase64sha256("${path.module}/../../../Data_Blending_Module/data_blender_queue_publisher.py")
+  source_code_hash = base64sha256(join("", [for file in ["Data_Blending_Module/data_blender_queue_publisher.py", "Data_Blending_Module/blend_distance.py", "Data_Blending_Module/blend_history.py", "API_Scraping_Module/sqs_batch.py"] : filesha256("${path.module}/../../../${file}")]))
   timeout          = 900
   memory_size      = 1024
 
+  # Name of environment variables to be passed to Lambda function
+  environment {
+    variables = {
+      "BLEND_MODE"           = var.blend_mode
+      "LISTINGS_PER_MESSAGE" = var.listings_per_message
+      "COMPRESS_MESSAGES"    = var.compress_messages
+    }
+  }
+
   depends_on = [
     aws_iam_role_policy_attachment.data_blender_queue_publisher,
     aws_cloudwatch_log_group.data_blender_queue_publisher,
@@ -336,7 +364,7 @@ resource "aws_lambda_function" "data_blender" {
     "arn:aws:lambda:ap-southeast-1:770693421928:layer:Klayers-p39-numpy:11"
   ]
   runtime          = "python3.9"
-  source_code_hash = filebase64sha256("${path.module}/../../../Data_Blending_Module/data_blender.py")
+  source_code_hash = base64sha256(join("", [for file in ["data_blender.py", "blend_distance.py", "blend_common.py"] : filesha256("${path.module}/../../../Data_Blending_Module/${file}")]))
   timeout          = 900
   memory_size      = 1024
 
@@ -351,6 +379,7 @@ resource "aws_lambda_event_source_mapping" "data_blender_sqs_trigger" {
   event_source_arn                   = var.data_blender_sqs_arn
   function_name                      = aws_lambda_function.data_blender.arn
   maximum_batching_window_in_seconds = 120
+  function_response_types            = ["ReportBatchItemFailures"]
 }
 
 ## Blended Data Merger
@@ -385,10 +414,17 @@ resource "aws_lambda_function" "blended_data_merger" {
   handler          = "blended_data_merger.handler"
   layers           = ["arn:aws:lambda:ap-southeast-1:336392948345:layer:AWSSDKPandas-Python39:5"]
   runtime          = "python3.9"
-  source_code_hash = filebase64sha256("${path.module}/../../../Data_Blending_Module/blended_data_merger.py") 
+  source_code_hash = base64sha256(join("", [for file in ["blended_data_merger.py", "blend_history.py"] : filesha256("${path.module}/../../../Data_Blending_Module/${file}")]))
   timeout          = 900
   memory_size      = 1024
 
+  # Name of environment variables to be passed to Lambda function
+  environment {
+    variables = {
+      "BLEND_MODE" = var.blend_mode
+    }
+  }
+
   depends_on = [
     aws_iam_role_policy_attachment.blended_data_merger,
     aws_cloudwatch_log_group.blended_data_merger,
@@ -3,6 +3,13 @@ variable "GEOAPIFY_API_KEY" {
   type = string
 }
 
+variable "GEOAPIFY_API_KEYS" {
+  description = "Comma separated Geoapify API keys the scraper tasks are spread over, empty to use GEOAPIFY_API_KEY only"
+  type = string
+  default = ""
+  sensitive = true
+}
+
 variable "GOOGLE_API_KEY" {
   description = "API Key for Google Maps"
   type = string
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules are deployed as single-file Lambda functions rather than packages, so they are imported from their directories
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "Data_Blending_Module"))
+sys.path.insert(0, os.path.join(ROOT, "API_Scraping_Module"))
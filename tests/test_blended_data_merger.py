@@ -0,0 +1,60 @@
+import io
+from datetime import datetime
+
+import pandas as pd
+from botocore.exceptions import ClientError
+
+import blended_data_merger
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.list_calls = []
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter=None, MaxKeys=1000, ContinuationToken=None):
+        self.list_calls.append((Prefix, Delimiter))
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))
+        if Delimiter is None:
+            return {"Contents": [{"Key": key} for key in keys], "IsTruncated": False}
+        prefixes = sorted({Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter for key in keys if Delimiter in key[len(Prefix):]})
+        return {"CommonPrefixes": [{"Prefix": prefix} for prefix in prefixes], "IsTruncated": False}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+
+    def download_fileobj(self, Bucket, Key, Fileobj):
+        Fileobj.write(self.objects[Key])
+
+    def upload_fileobj(self, Fileobj, Bucket, Key):
+        self.objects[Key] = Fileobj.read()
+
+
+def csv_bytes(df, index=False):
+    return df.to_csv(index=index).encode("utf-8")
+
+
+def test_incremental_merge_drops_listings_deleted_since_the_previous_blend(monkeypatch):
+    current_date = datetime.today().strftime("%Y-%m-%d")
+    previous_parts = pd.DataFrame({"longitude": [139.1, 139.2, 139.3], "latitude": [35.1, 35.2, 35.3], "1km_cafe_total_count": [1, 2, 3]})
+    s3 = FakeS3({
+        "blended/2000-01-01/merged_parts.csv": csv_bytes(previous_parts, index=True),
+        "blended/2000-01-01/parts/old.csv": b"",
+        # A blend without a merged output is skipped
+        "blended/2000-02-01/parts/unmerged.csv": b"",
+        f"blended/{current_date}/parts/new.csv": csv_bytes(pd.DataFrame({"longitude": [139.4], "latitude": [35.4], "1km_cafe_total_count": [4]})),
+        # The listing at 139.2, 35.2 was deleted upstream
+        "listings/tokyo.csv": csv_bytes(pd.DataFrame({"asset_name": ["a", "c", "d"], "longitude": [139.1, 139.3, 139.4], "latitude": [35.1, 35.3, 35.4]})),
+    })
+    monkeypatch.setattr(blended_data_merger.boto3, "client", lambda service: s3)
+
+    blended_data_merger.main(mode="incremental")
+
+    merged = pd.read_csv(io.BytesIO(s3.objects[f"blended/{current_date}/merged_parts.csv"]), index_col=0)
+    assert sorted(merged["longitude"]) == [139.1, 139.3, 139.4]
+    blended = pd.read_csv(io.BytesIO(s3.objects[f"blended/{current_date}/listings/tokyo.csv_blended.csv"]), index_col=0)
+    assert blended.set_index("asset_name")["1km_cafe_total_count"].to_dict() == {"a": 1, "c": 3, "d": 4}
+    # The previous blend is found from the date prefixes rather than by listing every part
+    assert ("blended/", None) not in s3.list_calls
+    assert ("blended/", "/") in s3.list_calls
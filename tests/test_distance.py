@@ -0,0 +1,57 @@
+import math
+
+import numpy as np
+import pytest
+
+import blend_distance
+
+TOLERANCE_KM = 1e-9
+
+
+def original_distance(lat1, lon1, lat2, lon2):
+    # The scalar haversine formula the vectorised kernel replaced
+    deg2rad = lambda x: x * (math.pi/180)
+    R = 6371 # Radius of the earth in km
+    dLat = deg2rad(lat2-lat1)
+    dLon = deg2rad(lon2-lon1)
+    a = math.sin(dLat/2) * math.sin(dLat/2) + math.cos(deg2rad(lat1)) * math.cos(deg2rad(lat2)) * math.sin(dLon/2) * math.sin(dLon/2)
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    return R * c
+
+
+def vectorised_distances(lat, lon, poi_lats, poi_lons):
+    return blend_distance.getDistancesFromLatLonInKm(lat, lon, np.radians(poi_lats), np.radians(poi_lons))
+
+
+def test_vectorised_kernel_matches_scalar_formula_on_random_coordinates():
+    rng = np.random.default_rng(0)
+    poi_lats = rng.uniform(-90, 90, 500)
+    poi_lons = rng.uniform(-180, 180, 500)
+
+    for lat, lon in zip(rng.uniform(-90, 90, 20), rng.uniform(-180, 180, 20)):
+        expected = [original_distance(lat, lon, poi_lat, poi_lon) for poi_lat, poi_lon in zip(poi_lats, poi_lons)]
+        np.testing.assert_allclose(vectorised_distances(lat, lon, poi_lats, poi_lons), expected, rtol=0, atol=TOLERANCE_KM)
+
+
+def test_vectorised_kernel_matches_scalar_formula_for_many_locations():
+    rng = np.random.default_rng(1)
+    lats, lons = rng.uniform(-90, 90, 30), rng.uniform(-180, 180, 30)
+    poi_lats, poi_lons = rng.uniform(-90, 90, 40), rng.uniform(-180, 180, 40)
+
+    expected = [[original_distance(lat, lon, poi_lat, poi_lon) for poi_lat, poi_lon in zip(poi_lats, poi_lons)] for lat, lon in zip(lats, lons)]
+    np.testing.assert_allclose(vectorised_distances(lats, lons, poi_lats, poi_lons), expected, rtol=0, atol=TOLERANCE_KM)
+
+
+@pytest.mark.parametrize("lat1, lon1, lat2, lon2", [
+    (35.6895, 139.6917, 35.6895, 139.6917),
+    (0, 0, 0, 0),
+    (90, 0, 90, 120),
+    (0, 0, 0, 180),
+    (35.6895, 139.6917, -35.6895, -40.3083),
+    (90, 0, -90, 0),
+])
+def test_vectorised_kernel_matches_scalar_formula_for_identical_and_antipodal_points(lat1, lon1, lat2, lon2):
+    distance = vectorised_distances(lat1, lon1, np.array([lat2]), np.array([lon2]))[0]
+
+    assert distance == pytest.approx(original_distance(lat1, lon1, lat2, lon2), abs=TOLERANCE_KM)
+    assert blend_distance.getDistanceFromLatLonInKm(lat1, lon1, lat2, lon2) == pytest.approx(distance, abs=TOLERANCE_KM)
@@ -0,0 +1,22 @@
+import pytest
+
+import geoapify_api_scraper
+
+
+def test_single_key_is_used_without_geoapify_api_keys(monkeypatch):
+    monkeypatch.setenv("GEOAPIFY_API_KEY", "single")
+    monkeypatch.delenv("GEOAPIFY_API_KEYS", raising=False)
+
+    assert geoapify_api_scraper.get_geoapify_api_key(0) == "single"
+    with pytest.raises(ValueError, match="GEOAPIFY_API_KEYS is not set"):
+        geoapify_api_scraper.get_geoapify_api_key(1)
+
+
+def test_key_is_picked_from_geoapify_api_keys(monkeypatch):
+    monkeypatch.setenv("GEOAPIFY_API_KEY", "single")
+    monkeypatch.setenv("GEOAPIFY_API_KEYS", "first, second")
+
+    assert geoapify_api_scraper.get_geoapify_api_key(0) == "first"
+    assert geoapify_api_scraper.get_geoapify_api_key(1) == "second"
+    with pytest.raises(ValueError, match="holds 2 keys"):
+        geoapify_api_scraper.get_geoapify_api_key(2)
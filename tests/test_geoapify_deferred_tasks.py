@@ -0,0 +1,66 @@
+import io
+import json
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+
+# The invoker creates its Lambda client on import
+os.environ.setdefault("AWS_DEFAULT_REGION", "ap-southeast-1")
+import geoapify_lambda_invoker
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    s3 = FakeS3()
+    dispatched = []
+    monkeypatch.setattr(geoapify_lambda_invoker.boto3, "client", lambda service: s3)
+    monkeypatch.setattr(geoapify_lambda_invoker, "load_category_stats", lambda client: {})
+    monkeypatch.setattr(geoapify_lambda_invoker, "main", lambda params: (dispatched.append(params), ("", True))[1])
+    s3.dispatched = dispatched
+    return s3
+
+
+def test_probe_credits_cover_every_quadtree_level():
+    assert geoapify_lambda_invoker.estimate_probe_credits(100, max_records=2000) == 1
+    assert geoapify_lambda_invoker.estimate_probe_credits(5000, max_records=2000) == 5
+    assert geoapify_lambda_invoker.estimate_probe_credits(40000, max_records=2000) == 85
+    # Clustered records of the previous run split into more tiles than even ones would
+    assert geoapify_lambda_invoker.estimate_probe_credits(5000, previous_tiles=10, max_records=2000) == 13
+
+
+def test_deferred_tasks_are_saved_and_dispatched_by_the_next_run(s3, monkeypatch):
+    # 2000 records default to 100 credits for the pages and 1 for the probe, so 2 of the 3 categories fit
+    monkeypatch.setattr(geoapify_lambda_invoker, "API_KEY_COUNT", 1)
+    monkeypatch.setattr(geoapify_lambda_invoker, "API_KEY_CREDITS", 202)
+    event = {"categories": ["beach", "airport", "pet"], "lon1": "139.0", "lat1": "35.5", "lon2": "139.9", "lat2": "35.9"}
+
+    report = geoapify_lambda_invoker.handler(event, None)["report"]
+    assert len(s3.dispatched) == 2
+    assert len(report["deferred_tasks"]) == 1
+    saved = json.loads(s3.objects[geoapify_lambda_invoker.DEFERRED_TASKS_KEY])
+    assert [task["category"] for task in saved] == [report["deferred_tasks"][0]["category"]]
+
+    # The next run only dispatches the deferred task, under the date of its run
+    report = geoapify_lambda_invoker.handler({"deferred": True}, None)["report"]
+    assert report["previously_deferred_tasks"] == 1
+    assert report["deferred_tasks"] == []
+    assert s3.dispatched[-1]["category"] == saved[0]["category"]
+    assert s3.dispatched[-1]["run_date"] == saved[0]["run_date"]
+    assert geoapify_lambda_invoker.DEFERRED_TASKS_KEY not in s3.objects
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+import requests
+
+import gmaps_api_scraper
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(f"HTTP {status_code}", response=response)
+
+
+@pytest.fixture
+def scraper(monkeypatch, tmp_path):
+    uploads = {}
+    monkeypatch.setenv("GOOGLE_API_KEY", "key")
+    monkeypatch.setattr(gmaps_api_scraper.boto3, "client", lambda service: None)
+    monkeypatch.setattr(gmaps_api_scraper, "object_exists", lambda client, key: False)
+    monkeypatch.setattr(gmaps_api_scraper, "load_place_id_cache", lambda client: None)
+    monkeypatch.setattr(gmaps_api_scraper, "save_place_id_cache", lambda client: None)
+    monkeypatch.setattr(gmaps_api_scraper, "upload_to_s3", lambda client, path, name: uploads.update({name: json.load(open(path))}))
+    return uploads
+
+
+def fail_records(monkeypatch, errors):
+    def google_place_details(term, lon, lat, google_api_key, cache_keys=None):
+        if term in errors:
+            raise errors[term]
+        return {"result": {"name": term, "rating": 4.0}}
+    monkeypatch.setattr(gmaps_api_scraper, "google_place_details", google_place_details)
+
+
+def records(*names):
+    return {name: {"name": name, "lon": 139.7, "lat": 35.7} for name in names}
+
+
+def test_direct_invocation_only_leaves_out_the_failed_records(scraper, monkeypatch, tmp_path):
+    fail_records(monkeypatch, {"b": http_error(503)})
+
+    message, failed = gmaps_api_scraper.main(records("a", "b", "c"), file_dir=str(tmp_path))
+
+    assert failed == ["b"]
+    [output] = scraper.values()
+    assert sorted(output) == ["a", "c"]
+
+
+def test_queued_records_return_only_their_failed_messages(scraper, monkeypatch, tmp_path):
+    fail_records(monkeypatch, {"b": requests.Timeout("timed out")})
+
+    message, failed = gmaps_api_scraper.main(records("a", "b", "c"), file_dir=str(tmp_path), message_ids={"a": "m1", "b": "m2", "c": "m2"})
+
+    assert failed == ["m2"]
+    [output] = scraper.values()
+    assert sorted(output) == ["a"]
+
+
+def test_client_errors_are_not_returned_to_the_queue(scraper, monkeypatch, tmp_path):
+    fail_records(monkeypatch, {"a": http_error(400), "b": http_error(403), "c": http_error(429)})
+
+    message, failed = gmaps_api_scraper.main(records("a", "b", "c"), file_dir=str(tmp_path), message_ids={"a": "m1", "b": "m2", "c": "m3"})
+
+    # A rate limit may succeed later, the other client errors fail the same way on every delivery
+    assert failed == ["m3"]
+    [output] = scraper.values()
+    assert output == {"a": records("a")["a"], "b": records("b")["b"]}
@@ -0,0 +1,61 @@
+import io
+import json
+
+import gmaps_lambda_queue_publisher
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        return [{"Contents": [{"Key": key} for key in sorted(self.objects) if key.startswith(Prefix)]}]
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+
+class FakeSQS:
+    def __init__(self):
+        self.bodies = []
+
+    def get_queue_url(self, QueueName):
+        return {"QueueUrl": QueueName}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.bodies.extend(entry["MessageBody"] for entry in Entries)
+        return {}
+
+
+def test_place_ids_published_by_another_segment_are_skipped(monkeypatch):
+    s3 = FakeS3({
+        "poi-api/2024-01-01/geoapify/cafe_geoapify_response.json": json.dumps({
+            "a": {"name": "a"}, "b": {"name": "b"}, "e": {"name": "e", "regions": ["west"]},
+        }).encode("utf-8"),
+        "poi-api/2024-01-01/geoapify/cafe_1_geoapify_response.json": json.dumps({
+            "b": {"name": "b"}, "c": {"name": "c"}, "e": {"name": "e", "regions": ["east"]},
+        }).encode("utf-8"),
+        "poi-api/2024-01-01/geoapify/bakery_geoapify_response.json": json.dumps({
+            "a": {"name": "a"}, "e": {"name": "e", "regions": ["west"]},
+        }).encode("utf-8"),
+    })
+    sqs = FakeSQS()
+    monkeypatch.setattr(gmaps_lambda_queue_publisher.boto3, "client", lambda service: sqs if service == "sqs" else s3)
+
+    published = []
+    for key in ["cafe_geoapify_response.json", "cafe_1_geoapify_response.json", "bakery_geoapify_response.json"]:
+        sqs.bodies = []
+        gmaps_lambda_queue_publisher.main("stonehenge-fyp", f"poi-api/2024-01-01/geoapify/{key}")
+        published.append({id: record for body in sqs.bodies for id, record in json.loads(body).items()})
+
+    assert sorted(published[0]) == ["a", "b", "e"]
+    # A POI on the edge between two regions is published again for the region it was not published with
+    assert published[1] == {"c": {"name": "c"}, "e": {"name": "e", "regions": ["east"]}}
+    assert published[2] == {}
+    assert gmaps_lambda_queue_publisher.publish_stats == {"records": 0, "duplicates": 2}
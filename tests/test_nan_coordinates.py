@@ -0,0 +1,97 @@
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import blend_common
+import data_blender
+import poi_blend
+
+TO_AGGREGATE = ["cafe", "park", "restaurant"]
+ADD_COLUMNS = ["total_count", "average_rating", "average_opening_hours"]
+TARGET_DISTANCE = [1, 3, 5]
+
+
+@pytest.fixture
+def poi_df():
+    rng = np.random.default_rng(0)
+    poi_count = 200
+    return pd.DataFrame({
+        "name": [f"poi {i}" for i in range(poi_count)],
+        "latitude": rng.uniform(35.65, 35.75, poi_count),
+        "longitude": rng.uniform(139.65, 139.75, poi_count),
+        "categories": [str([str(cat) for cat in rng.choice(TO_AGGREGATE, 2)]) for _ in range(poi_count)],
+        "rating": rng.choice([np.nan, 3.5, 4.0, 4.5], poi_count),
+        "user_ratings_total": rng.integers(0, 100, poi_count),
+        "opening_hours": rng.choice([np.nan, "Monday: 11:00 AM – 8:00 PM,Tuesday: Closed"], poi_count),
+    })
+
+
+def assert_nan_record(record, lat, lon):
+    assert set(record) == {f"{dist}km_{cat}_{col}" for cat in TO_AGGREGATE for col in ADD_COLUMNS for dist in TARGET_DISTANCE} | {"latitude", "longitude"}
+    assert all(math.isnan(value) for key, value in record.items() if key not in ("latitude", "longitude"))
+    assert record["latitude"] is lat or record["latitude"] == lat
+    assert record["longitude"] is lon or record["longitude"] == lon
+
+
+@pytest.mark.parametrize("lat, lon", [(math.nan, 139.7), (35.7, math.nan), (math.nan, math.nan), (math.inf, 139.7)])
+def test_candidate_indices_are_empty_for_non_finite_coordinates(poi_df, lat, lon):
+    spatial_index = blend_common.build_spatial_index(poi_df)
+    assert len(blend_common.get_candidate_indices(spatial_index, 5, lat, lon)) == 0
+
+
+def test_generate_records_gives_a_nan_record_for_nan_coordinates(poi_df):
+    records = [
+        {"latitude": 35.7, "longitude": 139.7},
+        {"latitude": math.nan, "longitude": 139.7},
+        {"latitude": 35.7, "longitude": math.nan},
+    ]
+    output = data_blender.generate_records(records, poi_df, TO_AGGREGATE, ADD_COLUMNS, TARGET_DISTANCE)
+
+    # The listing with valid coordinates is unaffected by the others in its batch
+    assert output[0] == data_blender.generate_records(records[:1], poi_df, TO_AGGREGATE, ADD_COLUMNS, TARGET_DISTANCE)[0]
+    assert output[0]["5km_cafe_total_count"] > 0
+    assert_nan_record(output[1], math.nan, 139.7)
+    assert_nan_record(output[2], 35.7, math.nan)
+
+
+def test_poi_blend_generate_record_gives_a_nan_record_for_nan_coordinates(poi_df):
+    record = poi_blend.generate_record(139.7, math.nan, poi_df, TO_AGGREGATE, ["total_count", "average_rating"], TARGET_DISTANCE)
+
+    assert record["latitude"] is math.nan or math.isnan(record["latitude"])
+    assert all(math.isnan(value) for key, value in record.items() if key not in ("latitude", "longitude"))
+
+
+def test_poi_blend_pooled_transform_resumes_with_nan_listings(poi_df, tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "output").mkdir()
+    listing_df = pd.DataFrame({
+        "asset_name": ["a", "b", "c", "d", "e", "f"],
+        "longitude": [139.7, math.nan, 139.71, 139.7, math.nan, 139.72],
+        "latitude": [35.7, 35.7, math.nan, 35.7, 35.7, 35.72],
+    })
+    add_columns = ["total_count", "average_rating"]
+    poi_blend.transform(poi_df.copy(), listing_df, TO_AGGREGATE, add_columns, TARGET_DISTANCE, "expected")
+
+    # Interrupt a pooled run once 2 of the 4 buildings are written, then resume it
+    write_chunk = poi_blend.write_chunk
+    written = []
+    def interrupted_write_chunk(*args):
+        if len(written) == 2:
+            raise KeyboardInterrupt
+        write_chunk(*args)
+        written.append(args[3])
+    monkeypatch.setattr(poi_blend, "write_chunk", interrupted_write_chunk)
+    with pytest.raises(KeyboardInterrupt):
+        poi_blend.transform(poi_df.copy(), listing_df, TO_AGGREGATE, add_columns, TARGET_DISTANCE, "pooled", workers=2, chunk_size=1)
+    monkeypatch.setattr(poi_blend, "write_chunk", write_chunk)
+    poi_blend.transform(poi_df.copy(), listing_df, TO_AGGREGATE, add_columns, TARGET_DISTANCE, "pooled", workers=2, chunk_size=1)
+
+    assert "Resuming [pooled]: 2/4 records already completed" in capsys.readouterr().out
+    assert not (tmp_path / "output" / "pooled.checkpoint.json").exists()
+    expected = pd.read_csv(tmp_path / "output" / "expected.csv").sort_values("asset_name", ignore_index=True)
+    pooled = pd.read_csv(tmp_path / "output" / "pooled.csv").sort_values("asset_name", ignore_index=True)
+    pd.testing.assert_frame_equal(pooled, expected)
+    assert len(pooled) == len(listing_df)
+    assert pooled.loc[pooled["asset_name"].isin(["b", "c", "e"]), "5km_cafe_total_count"].isna().all()